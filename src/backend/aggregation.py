@@ -0,0 +1,283 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Folding of consecutive membership and profile events into one `Event`."""
+
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import TYPE_CHECKING, DefaultDict, Dict, Optional, Tuple
+
+import nio
+
+from .models.items import Event, TypeSpecifier
+
+if TYPE_CHECKING:
+    from .matrix_client import MatrixClient
+
+
+def member_action(ev: nio.RoomMemberEvent) -> str:
+    """Return a short description of what a member event does."""
+
+    if ev.prev_content and ev.membership == ev.prev_membership:
+        return "profile changes"
+
+    if ev.membership == "leave":
+        return "left" if ev.state_key == ev.sender else "removed"
+
+    return {"join": "joined", "invite": "invited", "ban": "banned"}.get(
+        ev.membership, "membership changes",
+    )
+
+
+@dataclass
+class MemberEventRun:
+    """Consecutive member events of a room shown as a single `Event` item.
+
+    The item is the `Event` registered for the first event of the run,
+    its content is replaced by a summary when other events are folded in.
+    """
+
+    item:       Event    = field()
+    first_date: datetime = field()
+    last_date:  datetime = field()
+
+    # {event_id: (action, (sender, state_key))} of the events in this run
+    events: Dict[str, Tuple[str, Tuple[str, str]]] = field(
+        default_factory=dict,
+    )
+
+
+    def add(self, ev: nio.RoomMemberEvent, date: datetime) -> None:
+        """Count an event in this run."""
+
+        users                    = (ev.sender, ev.state_key)
+        self.events[ev.event_id] = (member_action(ev), users)
+        self.first_date          = min(self.first_date, date)
+        self.last_date           = max(self.last_date, date)
+
+
+    @property
+    def summary(self) -> str:
+        """Content for the run's `Event`, `%1` is the item's sender."""
+
+        users   = {user for _, pair in self.events.values() for user in pair}
+        actions = Counter(action for action, _ in self.events.values())
+        others  = len(users - {self.item.sender_id})
+        counts  = ", ".join(f"{n} {act}" for act, n in actions.items())
+
+        if others == 1:
+            return f"%1 and 1 other: {counts}"
+
+        if others:
+            return f"%1 and {others} others: {counts}"
+
+        return f"%1: {counts}"
+
+
+@dataclass
+class MemberEventsAggregator:
+    """Show runs of membership and profile events as one summary `Event`.
+
+    In busy rooms, most of the timeline can be made of join, leave and
+    profile change events. Instead of registering an `Event` for each,
+    events adjacent to a run already in the model are folded in it, and
+    the run's item is updated in place.
+
+    Runs can grow at both ends of the loaded timeline: the newest one
+    with events from syncs, the oldest one with past events loaded
+    from the server. Any other shown event registered beyond a run, or
+    a gap in the timeline after a limited sync, ends it.
+    """
+
+    client: "MatrixClient" = field(repr=False)
+
+    newest: Dict[str, MemberEventRun] = field(default_factory=dict)
+    oldest: Dict[str, MemberEventRun] = field(default_factory=dict)
+
+    # {room_id: {event_id: run}} for every event folded in a run
+    folded: DefaultDict[str, Dict[str, MemberEventRun]] = field(
+        default_factory=lambda: DefaultDict(dict),
+    )
+
+    # {room_id: date of the oldest event registered in the room's model}
+    oldest_dates: Dict[str, datetime] = field(default_factory=dict)
+
+
+    def _adjacent_run(
+        self, room_id: str, date: datetime,
+    ) -> Optional[MemberEventRun]:
+
+        for runs in (self.newest, self.oldest):
+            run = runs.get(room_id)
+
+            if run and not self._in_model(room_id, run):
+                del runs[room_id]
+                self._prune(room_id, run)
+
+        newest = self.newest.get(room_id)
+
+        if newest and date >= newest.last_date:
+            return newest
+
+        oldest = self.oldest.get(room_id)
+
+        if oldest and date <= oldest.first_date:
+            return oldest
+
+        return None
+
+
+    def _in_model(self, room_id: str, run: MemberEventRun) -> bool:
+        model = self.client.models[self.client.user_id, room_id, "events"]
+        return model.get(run.item.id) is run.item
+
+
+    def _prune(self, room_id: str, run: MemberEventRun) -> None:
+        """Forget the events of a run whose item was removed."""
+
+        folded = self.folded[room_id]
+
+        for event_id in run.events:
+            if folded.get(event_id) is run:
+                del folded[event_id]
+
+
+    def _registered(self, room_id: str, date: datetime) -> None:
+        oldest = self.oldest_dates.get(room_id)
+
+        if not oldest or date < oldest:
+            self.oldest_dates[room_id] = date
+
+
+    async def _update_item(
+        self, room: nio.MatrixRoom, run: MemberEventRun,
+    ) -> None:
+
+        # Past events are loaded in bulk mode, don't make the model send
+        # a snapshot of all its items for a change to one that was there
+        model = self.client.models[self.client.user_id, room.room_id, "events"]
+        model.reinsert_in_bulk(run.item.id)
+
+        item                = run.item
+        item.date           = max(item.date, run.last_date)
+        item.type_specifier = TypeSpecifier.MembershipChange
+        item.content        = run.summary
+        item.inline_content = item.content
+
+        await self.client.set_room_last_event(room.room_id, item)
+        await self.client.mark_room_dirty(room)
+
+
+    async def add(
+        self,
+        room:           nio.MatrixRoom,
+        ev:             nio.RoomMemberEvent,
+        type_specifier: TypeSpecifier,
+        content:        str,
+    ) -> None:
+        """Register a member event, or fold it in an adjacent run."""
+
+        room_id = room.room_id
+
+        folded_in = self.folded[room_id].get(ev.event_id)
+
+        if folded_in and self._in_model(room_id, folded_in):
+            return
+
+        if folded_in:
+            self._prune(room_id, folded_in)
+
+        date = datetime.fromtimestamp(ev.server_timestamp / 1000)
+        run  = self._adjacent_run(room_id, date)
+
+        if run:
+            run.add(ev, date)
+            self.folded[room_id][ev.event_id] = run
+            self._registered(room_id, date)
+            await self._update_item(room, run)
+            return
+
+        user_id   = self.client.user_id
+        model     = self.client.models[user_id, room_id, "events"]
+        room_item = self.client.models[user_id, "rooms"].get(room_id)
+        newest    = not room_item or date >= room_item.last_event_date
+        empty     = not model
+
+        # Events loaded in a gap between the spans of events we hold
+        # aren't at either end of the timeline
+        oldest_date = self.oldest_dates.get(room_id)
+        oldest      = empty or not oldest_date or date <= oldest_date
+
+        await self.client.register_nio_event(
+            room, ev, content=content, type_specifier=type_specifier,
+        )
+
+        if ev.event_id not in model:
+            return
+
+        self._registered(room_id, date)
+
+        run = MemberEventRun(model[ev.event_id], date, date)
+        run.add(ev, date)
+        self.folded[room_id][ev.event_id] = run
+
+        if newest:
+            self.newest[room_id] = run
+
+        if oldest:
+            self.oldest[room_id] = run
+
+
+    async def redact(self, room: nio.MatrixRoom, event_id: str) -> bool:
+        """Remove a redacted event from the run it was folded in.
+
+        Return whether the event was part of a run that still has other
+        events. If not, the redaction should be handled as usual.
+        """
+
+        run = self.folded[room.room_id].get(event_id)
+
+        if run and not self._in_model(room.room_id, run):
+            self._prune(room.room_id, run)
+            return False
+
+        if not run or len(run.events) < 2:
+            return False
+
+        del self.folded[room.room_id][event_id]
+        del run.events[event_id]
+
+        await self._update_item(room, run)
+        return True
+
+
+    def break_runs(self, room_id: str, date: datetime) -> None:
+        """End the runs that a shown event registered at `date` follows."""
+
+        self._registered(room_id, date)
+
+        newest = self.newest.get(room_id)
+
+        if newest and date >= newest.last_date:
+            del self.newest[room_id]
+
+        oldest = self.oldest.get(room_id)
+
+        if oldest and date <= oldest.first_date:
+            del self.oldest[room_id]
+
+
+    def timeline_gap(self, room_id: str) -> None:
+        """End the newest run, a limited sync left a gap of events after it.
+        """
+
+        self.newest.pop(room_id, None)
+
+
+    def forget(self, room_id: str) -> None:
+        """Forget the runs of a room, e.g. after its events were cleared."""
+
+        self.newest.pop(room_id, None)
+        self.oldest.pop(room_id, None)
+        self.folded.pop(room_id, None)
+        self.oldest_dates.pop(room_id, None)
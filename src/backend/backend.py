@@ -5,19 +5,25 @@ import logging as log
 import sys
 import traceback
 from pathlib import Path
-from typing import Any, DefaultDict, Dict, List, Optional
+from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple
 
 import nio
 from appdirs import AppDirs
 
 from . import __app_name__
 from .errors import MatrixError
+from .heap import GCMonitor, HeapSnapshots
+from .html_markdown import HTML_PROCESSOR
 from .matrix_client import MatrixClient
-from .media_cache import MediaCache
+from .media_cache import ACCESS_LOCKS, MediaCache
+from .metrics import Labels, Metrics, MetricsExporter
 from .models import SyncId
 from .models.items import Account
 from .models.model_store import ModelStore
+from .reconnection import HomeserverBackoff
+from .tasks import TaskRegistry
 from .user_files import Accounts, History, Theme, UISettings, UIState
+from .utils import deep_sizeof
 
 # Logging configuration
 log.getLogger().setLevel(log.INFO)
@@ -66,11 +72,36 @@ class Backend:
         clients: A `{user_id: MatrixClient}` dict for the logged-in clients
             we managed. Every client is logged to one matrix account.
 
+        homeserver_backoffs: A `{homeserver_url: HomeserverBackoff}` dict
+            of reconnection states shared by the clients of a homeserver.
+
         media_cache: A matrix media cache for downloaded files.
+
+        tasks: Registry of the background tasks started by the backend and
+            clients, also watching our lock tables.
+
+        metrics: Counters, gauges and histograms about the backend's health,
+            returned by `get_stats()` and `get_metrics()`.
+
+        metrics_exporter: Opt-in OpenMetrics server, configured with
+            the `metricsExporterAddress` UI setting.
+
+        gc_monitor: Garbage collection pauses measurement, and heap freezing
+            after the initial sync if the `freezeHeapAfterSync` UI setting
+            is enabled.
+
+        heap_snapshots: `tracemalloc` snapshots taken and compared with
+            `heap_snapshot_diff()`.
+
+        low_power: Whether the low-power mode, used while the UI is hidden,
+            is enabled. See `set_low_power()`.
+
+        foreground: Event set while the low-power mode is disabled.
     """
 
     def __init__(self) -> None:
         self.appdirs = AppDirs(appname=__app_name__, roaming=True)
+        self.tasks   = TaskRegistry()
 
         self.saved_accounts: Accounts   = Accounts(self)
         self.ui_settings:    UISettings = UISettings(self)
@@ -80,6 +111,9 @@ class Backend:
         self.models:  ModelStore              = ModelStore()
         self.clients: Dict[str, MatrixClient] = {}
 
+        self.homeserver_backoffs: DefaultDict[str, HomeserverBackoff] = \
+                DefaultDict(HomeserverBackoff)
+
         self.profile_cache: Dict[str, nio.ProfileGetResponse] = {}
         self.get_profile_locks: DefaultDict[str, asyncio.Lock] = \
                 DefaultDict(asyncio.Lock)  # {user_id: lock}
@@ -90,6 +124,31 @@ class Backend:
         cache_dir                    = Path(self.appdirs.user_cache_dir)
         self.media_cache: MediaCache = MediaCache(self, cache_dir)
 
+        self.metrics:          Metrics         = Metrics()
+        self.metrics_exporter: MetricsExporter = MetricsExporter(self)
+        self.gc_monitor:       GCMonitor       = GCMonitor(self.metrics)
+        self.gc_monitor.install()
+
+        self.heap_snapshots: HeapSnapshots = HeapSnapshots()
+
+        self.low_power:  bool          = False
+        self.foreground: asyncio.Event = asyncio.Event()
+        self.foreground.set()
+
+        self.tasks.lock_tables.update({
+            "get_profile_locks":  self.get_profile_locks,
+            "send_locks":         self.send_locks,
+            "media_access_locks": ACCESS_LOCKS,
+        })
+
+        self.tasks.create(self.tasks.watch(), "watch", "tasks", daemon=True)
+        self.tasks.create(
+            self.metrics.monitor_loop_lag(self.foreground),
+            "monitor_loop_lag",
+            "metrics",
+            daemon=True,
+        )
+
 
     def __repr__(self) -> str:
         return f"{type(self).__name__}(clients={self.clients!r})"
@@ -255,9 +314,38 @@ class Backend:
         history  = await self.history.read()
         theme    = await Theme(self, settings["theme"]).read()
 
+        await self.metrics_exporter.apply(settings["metricsExporterAddress"])
+
         return (settings, ui_state, history, theme)
 
 
+    async def set_low_power(self, enabled: bool) -> None:
+        """Enable or disable the low-power mode, used while the UI is hidden.
+
+        In this mode, clients sync with longer timeouts and ignore typing
+        notices, media downloads not requested by the user wait for the
+        mode to be disabled, and model changes are queued to be sent to
+        QML when it is.
+        """
+
+        if enabled == self.low_power:
+            return
+
+        self.low_power = enabled
+        self.metrics.set("low_power_mode", int(enabled))
+
+        if enabled:
+            self.foreground.clear()
+        else:
+            self.foreground.set()
+
+        for user_id, client in self.clients.items():
+            self.models.defer_events(user_id, enabled)
+
+            if enabled:
+                client.clear_typing()
+
+
     async def await_model_item(
         self, model_id: SyncId, item_id: Any,
     ) -> Dict[str, Any]:
@@ -279,3 +367,154 @@ class Backend:
 
                 await asyncio.sleep(0.1)
                 failures += 1
+
+
+    # Debugging functions
+
+    def _computed_gauges(self) -> Dict[str, Dict[Labels, float]]:
+        """Return gauges for `Metrics` that are read from our models."""
+
+        items: DefaultDict[Labels, float] = DefaultDict(float)
+
+        for sync_id, model in self.models.items():
+            if isinstance(sync_id, tuple):
+                labels = (("account", sync_id[0]), ("kind", sync_id[-1]))
+            else:
+                labels = (("account", ""), ("kind", sync_id))
+
+            items[labels] += len(model)
+
+        tasks: DefaultDict[Labels, float] = DefaultDict(float)
+
+        for info in self.tasks.tasks.values():
+            group = info.owner[0] if info.owner else ""
+            tasks[("owner", group), ("name", info.name)] += 1
+
+        locks = {
+            (("table", name),): len(table)
+            for name, table in self.tasks.lock_tables.items()
+        }
+
+        backoffs = {
+            (("homeserver", url),): backoff.failures
+            for url, backoff in self.homeserver_backoffs.items()
+        }
+
+        return {
+            "models":              {(): len(self.models)},
+            "model_items":         items,
+            "background_tasks":    tasks,
+            "lock_table_entries":  locks,
+            "homeserver_failures": backoffs,
+            **self.gc_monitor.gauges(),
+        }
+
+
+    async def get_stats(self) -> Dict[str, Any]:
+        """Return a `{metric: {labels: value}}` dict of backend statistics."""
+
+        return self.metrics.as_dict(self._computed_gauges())
+
+
+    async def get_metrics(self) -> str:
+        """Return our backend statistics in the OpenMetrics text format."""
+
+        return self.metrics.render(self._computed_gauges())
+
+
+    async def tasks_report(self) -> str:
+        """Return a human-readable list of running tasks and lock tables.
+
+        Tasks owned by accounts that are no longer logged in are
+        reported as leaked.
+        """
+
+        owners = {
+            info.owner[0] for info in self.tasks.tasks.values()
+            if info.owner and info.owner[0].startswith("@")
+        }
+        return self.tasks.report(orphan_owners=owners - set(self.clients))
+
+
+    async def heap_snapshot_diff(self, top: int = 10) -> str:
+        """Return a report of the heap changes since the last call.
+
+        Memory allocation tracing is started on the first call,
+        see `HeapSnapshots.diff()`.
+        """
+
+        return await self.heap_snapshots.diff(top)
+
+
+    async def memory_usage(self) -> List[Tuple[str, int, Dict[str, int]]]:
+        """Return an estimation of the memory retained by our data structures.
+
+        Returns a list of `(name, total_size, {detail: size})` tuples
+        with sizes in bytes, for every `Model` in our `ModelStore`,
+        the known room members names of the `HTMLProcessor`,
+        the profile cache, the lock tables and each client's nio rooms.
+        """
+
+        usage: List[Tuple[str, int, Dict[str, int]]] = []
+
+        for model in self.models.values():
+            details = model.memory_usage()
+            usage.append((str(model.sync_id), details.pop("total"), details))
+
+        singles: Dict[str, Any] = {
+            "HTMLProcessor.rooms_user_id_names":
+                HTML_PROCESSOR.rooms_user_id_names,
+
+            "Backend.profile_cache": self.profile_cache,
+        }
+
+        grouped: Dict[str, Dict[str, Any]] = {
+            "Lock tables": dict(self.tasks.lock_tables),
+        }
+
+        for user_id, client in self.clients.items():
+            grouped[f"{user_id} nio rooms"] = {
+                "rooms":         client.rooms,
+                "invited_rooms": client.invited_rooms,
+            }
+
+        for name, obj in singles.items():
+            usage.append((name, deep_sizeof(obj), {}))
+
+        for name, parts in grouped.items():
+            seen: Set[int] = set()
+            details        = {
+                part: deep_sizeof(obj, seen) for part, obj in parts.items()
+            }
+            usage.append((name, sum(details.values()), details))
+
+        return usage
+
+
+    async def memory_report(self, sort_by_size: bool = True) -> str:
+        """Return a human-readable table of `Backend.memory_usage()` results.
+
+        Entries are sorted by descending size if `sort_by_size` is `True`,
+        else by name.
+        """
+
+        def kib(size: int) -> str:
+            return f"{size / 1024:,.1f} KiB"
+
+        usage = sorted(
+            await self.memory_usage(),
+            key     = lambda entry: entry[1] if sort_by_size else entry[0],
+            reverse = sort_by_size,
+        )
+
+        lines = []
+
+        for name, size, details in usage:
+            lines.append(f"{kib(size):>14}  {name}")
+
+            for detail, detail_size in details.items():
+                lines.append(f"{kib(detail_size):>14}      {detail}")
+
+        total = sum(size for _, size, _ in usage)
+        lines.append(f"{kib(total):>14}  Total")
+        return "\n".join(lines)
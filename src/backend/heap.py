@@ -0,0 +1,277 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Garbage collector monitoring and tuning, heap snapshots comparison."""
+
+import asyncio
+import gc
+import logging as log
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, DefaultDict, Dict, Optional, Tuple
+
+from .metrics import Labels
+
+if TYPE_CHECKING:
+    from .metrics import Metrics
+
+GC_PAUSE_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5,
+)
+
+# With most of the heap frozen after the initial sync, the objects created
+# by following syncs are mostly short-lived: collect the youngest generation
+# less often, which means less pauses for mostly nothing to collect.
+FROZEN_HEAP_THRESHOLDS = (10_000, 20, 20)
+
+# Backend modules for which allocations are grouped in snapshot comparisons
+SNAPSHOT_GROUPS = ("models", "media_cache", "html_markdown", "matrix_client")
+
+
+@dataclass
+class GCMonitor:
+    """Measure the garbage collector's pauses and optionally freeze the heap.
+
+    Once installed, the time taken by every collection is observed in the
+    `gc_pause_seconds` histogram of `metrics`, labeled by generation.
+
+    `freeze()` moves all objects currently tracked by the collector to a
+    permanent generation that future collections will ignore.
+    It is meant to be called once the initial sync has loaded
+    our long-lived models, events and nio objects.
+    """
+
+    metrics: "Metrics" = field(repr=False)
+
+    freeze_report: Dict[str, Any] = field(default_factory=dict)
+
+    _start: Optional[float] = field(init=False, default=None)
+
+
+    def install(self) -> None:
+        """Start measuring garbage collections."""
+
+        if self._on_gc not in gc.callbacks:
+            gc.callbacks.append(self._on_gc)
+
+
+    def uninstall(self) -> None:
+        """Stop measuring garbage collections."""
+
+        if self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+
+
+    def _on_gc(self, phase: str, info: Dict[str, int]) -> None:
+        if phase == "start":
+            self._start = time.perf_counter()
+            return
+
+        if self._start is None:  # installed during a collection
+            return
+
+        pause       = time.perf_counter() - self._start
+        self._start = None
+        generation  = info["generation"]
+
+        self.metrics.observe(
+            "gc_pause_seconds", pause, GC_PAUSE_BUCKETS, generation=generation,
+        )
+        self.metrics.increment(
+            "gc_collected_objects", info["collected"], generation=generation,
+        )
+
+
+    @staticmethod
+    def _timed_full_collection() -> float:
+        start = time.perf_counter()
+        gc.collect()
+        return time.perf_counter() - start
+
+
+    def freeze(
+        self, thresholds: Tuple[int, int, int] = FROZEN_HEAP_THRESHOLDS,
+    ) -> Dict[str, Any]:
+        """Freeze the current heap and set new generation thresholds.
+
+        Garbage is collected first to avoid freezing it forever.
+        Return and store in `freeze_report` a dict comparing the
+        thresholds, frozen objects count and duration of a full collection
+        before and after freezing.
+        """
+
+        before = {
+            "thresholds":           gc.get_threshold(),
+            "frozen_objects":       gc.get_freeze_count(),
+            "full_collection_time": self._timed_full_collection(),
+        }
+
+        gc.freeze()
+        gc.set_threshold(*thresholds)
+
+        after = {
+            "thresholds":           gc.get_threshold(),
+            "frozen_objects":       gc.get_freeze_count(),
+            "full_collection_time": self._timed_full_collection(),
+        }
+
+        self.freeze_report = {"before": before, "after": after}
+
+        log.info(
+            "Froze %d objects, full GC pause went from %.1fms to %.1fms",
+            after["frozen_objects"],
+            before["full_collection_time"] * 1000,
+            after["full_collection_time"] * 1000,
+        )
+
+        return self.freeze_report
+
+
+    def gauges(self) -> Dict[str, Dict[Labels, float]]:
+        """Return the collector's current state as gauges for `Metrics`."""
+
+        generations = range(len(gc.get_threshold()))
+
+        gauges: Dict[str, Dict[Labels, float]] = {
+            "gc_threshold": {
+                (("generation", str(gen)),): gc.get_threshold()[gen]
+                for gen in generations
+            },
+            "gc_pending_objects": {
+                (("generation", str(gen)),): gc.get_count()[gen]
+                for gen in generations
+            },
+            "gc_frozen_objects": {(): gc.get_freeze_count()},
+        }
+
+        if self.freeze_report:
+            gauges["gc_full_collection_seconds"] = {
+                (("when", f"{when}_freeze"),): report["full_collection_time"]
+                for when, report in self.freeze_report.items()
+            }
+
+        return gauges
+
+
+@dataclass
+class HeapSnapshots:
+    """Take `tracemalloc` snapshots and compare them to find memory leaks.
+
+    Tracing starts with the first snapshot, since it slows down
+    every allocation. Allocations are attributed to the most recent frame
+    in their traceback that is part of one of the `SNAPSHOT_GROUPS` backend
+    modules or of nio, so that e.g. a dict created by `json` for a nio
+    response is counted for nio instead of the standard library.
+    """
+
+    frames: int = 25
+
+    previous:      Optional[tracemalloc.Snapshot] = None
+    previous_date: float                          = 0
+
+
+    @staticmethod
+    def _group(filename: str) -> Optional[str]:
+        parts = Path(filename).parts
+
+        if "nio" in parts:
+            return "nio"
+
+        if "backend" not in parts:
+            return None
+
+        # Use the last "backend" in the path, in case of a parent directory
+        # with the same name
+        backend_index = len(parts) - 1 - parts[::-1].index("backend")
+        module_parts  = parts[backend_index + 1:]
+        module        = Path(module_parts[0]).stem if module_parts else ""
+
+        if module in SNAPSHOT_GROUPS:
+            return module
+
+        return "backend"
+
+
+    def _attribute(self, trace: tracemalloc.Traceback) -> Tuple[str, str]:
+        """Return the `(group, "file:line")` responsible for an allocation."""
+
+        for frame in reversed(trace):  # most recent frame first
+            group = self._group(frame.filename)
+
+            if group:
+                return (group, f"{frame.filename}:{frame.lineno}")
+
+        frame = trace[-1]
+        return ("other", f"{frame.filename}:{frame.lineno}")
+
+
+    def _compare(
+        self,
+        new:  tracemalloc.Snapshot,
+        old:  tracemalloc.Snapshot,
+        ago:  float,
+        top:  int,
+    ) -> str:
+        def kib(size: int) -> str:
+            return f"{size / 1024:+,.1f} KiB"
+
+        group_sizes:  DefaultDict[str, int]             = DefaultDict(int)
+        group_counts: DefaultDict[str, int]             = DefaultDict(int)
+        site_sizes:   DefaultDict[Tuple[str, str], int] = DefaultDict(int)
+
+        for diff in new.compare_to(old, "traceback"):
+            group, site = self._attribute(diff.traceback)
+
+            group_sizes[group]       += diff.size_diff
+            group_counts[group]      += diff.count_diff
+            site_sizes[group, site]  += diff.size_diff
+
+        total = sum(group_sizes.values())
+        lines = [f"{kib(total)} since previous snapshot taken {ago:.0f}s ago"]
+
+        for group in sorted(group_sizes, key=lambda g: -abs(group_sizes[g])):
+            lines.append("%16s  %+d blocks  %s" % (
+                kib(group_sizes[group]), group_counts[group], group,
+            ))
+
+            sites = sorted(
+                (site for g, site in site_sizes if g == group),
+                key = lambda site: -abs(site_sizes[group, site]),
+            )
+
+            for site in sites[:top]:
+                lines.append(f"{kib(site_sizes[group, site]):>16}      {site}")
+
+        return "\n".join(lines)
+
+
+    async def diff(self, top: int = 10) -> str:
+        """Take a snapshot and compare it to the previous one.
+
+        Return a human-readable report of the memory allocated and freed
+        between the two snapshots, grouped by module, with the `top`
+        allocation sites that grew or shrank the most for each group.
+        """
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.previous = None
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+
+        now                = time.monotonic()
+        previous, ago      = self.previous, now - self.previous_date
+        self.previous      = snapshot
+        self.previous_date = now
+
+        if not previous:
+            return "Tracing started, first snapshot taken"
+
+        # Comparing big snapshots takes a while, don't block the loop
+        return await asyncio.get_event_loop().run_in_executor(
+            None, self._compare, snapshot, previous, ago, top,
+        )
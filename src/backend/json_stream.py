@@ -0,0 +1,160 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Incremental parsing of big JSON documents received over HTTP."""
+
+import codecs
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator
+
+import aiohttp
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+@dataclass
+class JSONStream:
+    """Parse a JSON document piece by piece as it is read from a stream.
+
+    Instead of decoding the whole document in one go, the caller walks
+    through its objects with `object_items()` and decodes the values it
+    wants with `value()`, so that only the value being decoded and
+    what is left of the current network chunk need to be held in memory.
+
+    Example, to handle the rooms of a sync response one at a time:
+
+        async for key in stream.object_items():
+            if key == "rooms":
+                async for category in stream.object_items():
+                    async for room_id in stream.object_items():
+                        handle(category, room_id, await stream.value())
+            else:
+                await stream.value()
+
+    Attributes:
+        read_bytes: Number of bytes read from the stream so far.
+    """
+
+    reader:     aiohttp.StreamReader = field(repr=False)
+    chunk_size: int                  = 64 * 1024
+
+    read_bytes: int  = field(init=False, default=0)
+    eof:        bool = field(init=False, default=False)
+
+    _buffer:  str = field(init=False, repr=False, default="")
+    _pos:     int = field(init=False, repr=False, default=0)
+    _decoder: json.JSONDecoder = field(
+        init=False, repr=False, default_factory=json.JSONDecoder,
+    )
+    _utf8: codecs.IncrementalDecoder = field(
+        init=False,
+        repr=False,
+        default_factory=lambda: codecs.getincrementaldecoder("utf-8")(),
+    )
+
+
+    async def _read(self, at_least: int = 1) -> None:
+        """Append at least `at_least` characters to the buffer if possible.
+
+        Consumed characters are dropped from the buffer.
+        """
+
+        new = []
+        got = 0
+
+        while got < at_least and not self.eof:
+            chunk            = await self.reader.read(self.chunk_size)
+            self.read_bytes += len(chunk)
+            self.eof         = not chunk
+            text             = self._utf8.decode(chunk, final=self.eof)
+            got             += len(text)
+            new.append(text)
+
+        self._buffer = self._buffer[self._pos:] + "".join(new)
+        self._pos    = 0
+
+
+    def _error(self, message: str) -> json.JSONDecodeError:
+        return json.JSONDecodeError(message, self._buffer, self._pos)
+
+
+    async def _skip_whitespace(self) -> None:
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+
+            if self._pos < len(self._buffer) or self.eof:
+                return
+
+            await self._read()
+
+
+    async def _next_char(self) -> str:
+        await self._skip_whitespace()
+
+        if self._pos >= len(self._buffer):
+            raise self._error("Unexpected end of document")
+
+        self._pos += 1
+        return self._buffer[self._pos - 1]
+
+
+    async def _expect(self, char: str) -> None:
+        if await self._next_char() != char:
+            self._pos -= 1
+            raise self._error(f"Expecting {char!r}")
+
+
+    async def value(self) -> Any:
+        """Decode and return the next complete JSON value."""
+
+        await self._skip_whitespace()
+
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            else:
+                # A number ending the buffer may continue in the next chunk
+                if end < len(self._buffer) or self.eof:
+                    self._pos = end
+                    return value
+
+            # Double what we have for this value, to not re-decode it from
+            # the start for every chunk
+            await self._read(max(self.chunk_size, len(self._buffer)))
+
+
+    async def object_items(self) -> AsyncIterator[str]:
+        """Iterate over the keys of the next JSON object.
+
+        After receiving a key, the caller must consume the corresponding
+        value with `value()` or `object_items()` before asking for the next.
+        """
+
+        await self._expect("{")
+        await self._skip_whitespace()
+
+        if self._buffer[self._pos:self._pos + 1] == "}":
+            self._pos += 1
+            return
+
+        while True:
+            key = await self.value()
+
+            if not isinstance(key, str):
+                raise self._error("Expecting object key string")
+
+            await self._expect(":")
+            yield key
+
+            separator = await self._next_char()
+
+            if separator == "}":
+                return
+
+            if separator != ",":
+                self._pos -= 1
+                raise self._error("Expecting ',' or '}'")
@@ -8,45 +8,91 @@ import io
 import logging as log
 import platform
 import re
+import time
 import traceback
-from contextlib import suppress
+from collections import deque
+from contextlib import contextmanager
 from copy import copy
 from datetime import datetime, timedelta
 from functools import partial
 from pathlib import Path
+from types import MappingProxyType
 from typing import (
-    TYPE_CHECKING, Any, DefaultDict, Dict, List, NamedTuple, Optional, Set,
-    Tuple, Type, Union,
+    TYPE_CHECKING, Any, DefaultDict, Dict, Iterable, Iterator, List,
+    Mapping, NamedTuple, Optional, Sequence, Set, Tuple, Type, Union,
 )
 from urllib.parse import urlparse
 from uuid import UUID, uuid4
 
 import cairosvg
+from aiohttp import ClientResponse
 from PIL import Image as PILImage
 from pymediainfo import MediaInfo
 
 import nio
+from nio.client.base_client import store_loaded
 from nio.crypto import AsyncDataT as UploadData
 from nio.crypto import async_generator_from_data
 
 from . import __app_name__, __display_name__, utils
+from .aggregation import MemberEventsAggregator
 from .errors import (
     BadMimeType, InvalidUserId, InvalidUserInContext, MatrixError,
     MatrixNotFound, MatrixTooLarge, UneededThumbnail,
     UserFromOtherServerDisallowed,
 )
 from .html_markdown import HTML_PROCESSOR as HTML
+from .json_stream import JSONStream
 from .media_cache import Media, Thumbnail
+from .metrics import SIZE_BUCKETS
 from .models.items import Event, Member, Room, Upload, UploadStatus, ZeroDate
 from .models.model_store import ModelStore
 from .nio_callbacks import NioCallbacks
+from .pagination import RoomPager, TimelineGaps
 from .pyotherside_events import AlertRequested, LoopException
+from .sync_cache import SyncCache
 
 if TYPE_CHECKING:
     from .backend import Backend
 
 CryptDict = Dict[str, Any]
 
+# Room timeline event types we show or that nio needs for the room state.
+# When hideUnknownEvents is on, the server doesn't have to send others.
+# m.room.member events can't be dropped even if hideMembershipEvents and
+# hideProfileChangeEvents are on, they keep nio's member lists up to date.
+KNOWN_TIMELINE_EVENT_TYPES = (
+    "m.room.message", "m.room.encrypted", "m.room.redaction",
+    "m.room.member", "m.room.create", "m.room.guest_access",
+    "m.room.join_rules", "m.room.history_visibility", "m.room.power_levels",
+    "m.room.canonical_alias", "m.room.name", "m.room.avatar",
+    "m.room.topic", "m.room.encryption",
+)
+
+# Concurrent requests for rooms without visible events after the first sync
+BACKGROUND_LOADERS = 4
+
+# Sync long-polling timeout in milliseconds while the UI is inactive
+LOW_POWER_SYNC_TIMEOUT = 90_000
+
+# Megolm events decrypted before letting other tasks run
+DECRYPTION_CHUNK_SIZE = 50
+
+# Decryption keys imported or exported between each progress report
+KEYS_TRANSFER_BATCH = 200
+
+# {state_event_type: (cached Room field groups it affects)},
+# "summary" stands for changes in a sync response's room summary
+ROOM_FIELDS_DEPENDENCIES = {
+    "summary":                ("name",),
+    "m.room.power_levels":    ("permissions",),
+    "m.room.name":            ("name",),
+    "m.room.canonical_alias": ("name",),
+    "m.room.member":          ("name", "avatar"),
+    "m.room.avatar":          ("avatar",),
+    "m.room.topic":           ("topic",),
+}
+
 
 class UploadReturn(NamedTuple):
     """Details for an uploaded file."""
@@ -111,11 +157,22 @@ class MatrixClient(nio.AsyncClient):
         self.backend: "Backend"  = backend
         self.models:  ModelStore = self.backend.models
 
+        # nio's room dicts are observed to maintain the all_rooms view
+        self._all_rooms:      Dict[str, nio.MatrixRoom]    = {}
+        self._all_rooms_view: Mapping[str, nio.MatrixRoom] = \
+            MappingProxyType(self._all_rooms)
+
+        self.rooms         = utils.ObservedDict(self._update_all_rooms)
+        self.invited_rooms = utils.ObservedDict(self._update_all_rooms)
+
         self.profile_task:       Optional[asyncio.Future] = None
         self.server_config_task: Optional[asyncio.Future] = None
         self.sync_task:          Optional[asyncio.Future] = None
         self.load_rooms_task:    Optional[asyncio.Future] = None
 
+        # Task waiting for the current sync request to be answered, if any
+        self.sync_request_task: Optional[asyncio.Future] = None
+
         self.upload_monitors:    Dict[UUID, nio.TransferMonitor] = {}
         self.upload_tasks:       Dict[UUID, asyncio.Task]        = {}
         self.send_message_tasks: Dict[UUID, asyncio.Task]        = {}
@@ -123,13 +180,50 @@ class MatrixClient(nio.AsyncClient):
         self.first_sync_done: asyncio.Event      = asyncio.Event()
         self.first_sync_date: Optional[datetime] = None
 
-        self.past_tokens:          Dict[str, str] = {}     # {room_id: token}
-        self.fully_loaded_rooms:   Set[str]       = set()  # {room_id}
-        self.loaded_once_rooms:    Set[str]       = set()  # {room_id}
-        self.cleared_events_rooms: Set[str]       = set()  # {room_id}
+        self.timeline_gaps: Dict[str, TimelineGaps] = {}  # {room_id: gaps}
+        self.sync_since:    str                     = ""  # current sync token
+
+        # (sync token, timeline event IDs) handled from a streamed sync
+        # response for this token, see _stream_sync_response()
+        self.streamed_sync_events: Tuple[str, Set[str]] = ("", set())
+
+        self.loaded_once_rooms:    Set[str] = set()  # {room_id}
+        self.cleared_events_rooms: Set[str] = set()  # {room_id}
 
         self.skipped_events: DefaultDict[str, int] = DefaultDict(lambda: 0)
 
+        # {(room_id, session_id): {event_id}} of events we failed to decrypt
+        self.undecryptable: DefaultDict[Tuple[str, str], Set[str]] = \
+            DefaultDict(set)
+
+        self.pagers: Dict[str, RoomPager] = {}  # {room_id: pager}
+
+        self.member_events = MemberEventsAggregator(self)
+
+        # Background work yields to interactive requests, see interactive()
+        self.interactive_requests: int           = 0
+        self.interactive_idle:     asyncio.Event = asyncio.Event()
+        self.interactive_idle.set()
+
+        # {room_id} of rooms to register again in flush_dirty_rooms()
+        self.dirty_rooms: Set[str] = set()
+
+        # {room_id: {user_id}} of members to update on next room registration
+        self.dirty_members: DefaultDict[str, Set[str]] = DefaultDict(set)
+
+        # {room_id: {user_id}} of members currently typing
+        self.typing_users: Dict[str, Set[str]] = {}
+
+        # {room_id: {field_group: {field: value}}}, see _derived_room_fields
+        self.derived_room_fields: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+        # time.monotonic() of the first failure since the last successful sync
+        self.offline_since: Optional[float] = None
+
+        self._sync_filter:          Dict[str, Any] = {}
+        self._sync_filter_settings: Tuple[Any, ...] = ()
+
+        self.sync_cache    = SyncCache(self)
         self.nio_callbacks = NioCallbacks(self)
 
 
@@ -150,11 +244,378 @@ class MatrixClient(nio.AsyncClient):
         response = await super()._send(*args, **kwargs)
 
         if isinstance(response, nio.ErrorResponse):
+            self.backend.metrics.increment(
+                "matrix_errors",
+                account   = self.user_id,
+                http_code = response.transport_response.status,
+                m_code    = response.status_code,
+            )
             raise MatrixError.from_nio(response)
 
         return response
 
 
+    async def receive_response(self, response: nio.Response) -> None:
+        """Update the client's state for a response from the server.
+
+        For `RoomMessagesResponse`s, nio would decrypt the whole page's
+        events at once. This is done instead with `decrypt_megolm_events()`,
+        which lets other tasks run while decrypting big pages.
+        """
+
+        if not isinstance(response, nio.RoomMessagesResponse):
+            await super().receive_response(response)
+            return
+
+        encrypted = [
+            (index, ev) for index, ev in enumerate(response.chunk)
+            if isinstance(ev, nio.MegolmEvent)
+        ]
+
+        decrypted = await self.decrypt_megolm_events(
+            response.room_id, [ev for _, ev in encrypted],
+        )
+
+        for (index, _), event in zip(encrypted, decrypted):
+            if event:
+                response.chunk[index] = event
+
+
+    async def _handle_joined_rooms(self, response: nio.Response) -> None:
+        """Handle the joined rooms of a sync response or streamed part.
+
+        Before nio calls our callbacks for a room's timeline events,
+        end its newest member events run if the sync left a gap after it.
+        """
+
+        for room_id, info in response.rooms.join.items():
+            if info.timeline.limited:
+                self.member_events.timeline_gap(room_id)
+
+        await super()._handle_joined_rooms(response)
+
+
+    @property
+    def sync_filter(self) -> Dict[str, Any]:
+        """Return a sync filter built from the current UI settings.
+
+        Member events are lazy-loaded, presence events are dropped,
+        the number of timeline events per room is limited by the
+        `syncTimelineLimit` setting, and unknown timeline events are dropped
+        if the `hideUnknownEvents` setting is on.
+        Typing notices are dropped while in low-power mode.
+        The filter is only rebuilt when these settings change.
+        """
+
+        settings = self.backend.ui_settings
+        current  = (
+            settings["syncTimelineLimit"],
+            settings["hideUnknownEvents"],
+            self.backend.low_power,
+        )
+
+        if current == self._sync_filter_settings and self._sync_filter:
+            return self._sync_filter
+
+        timeline_limit, hide_unknown, low_power = current
+
+        timeline: Dict[str, Any] = {
+            "limit":             timeline_limit,
+            "lazy_load_members": True,
+        }
+
+        if hide_unknown:
+            timeline["types"] = list(KNOWN_TIMELINE_EVENT_TYPES)
+
+        self._sync_filter_settings = current
+        self._sync_filter          = {
+            "presence": {"not_types": ["*"]},
+            "room":     {
+                "state":    {"lazy_load_members": True},
+                "timeline": timeline,
+            },
+        }
+
+        if low_power:
+            room_filter              = self._sync_filter["room"]
+            room_filter["ephemeral"] = {"not_types": ["m.typing"]}
+
+        return self._sync_filter
+
+
+    async def sync(
+        self,
+        timeout:     Optional[int]            = None,
+        sync_filter: Optional[Dict[str, Any]] = None,
+        since:       Optional[str]            = None,
+        full_state:  Optional[bool]           = None,
+    ) -> nio.SyncResponse:
+        """Sync with the server, recording the request duration.
+
+        If no `sync_filter` is passed, `MatrixClient.sync_filter` is used.
+        In low-power mode, the server can wait up to `LOW_POWER_SYNC_TIMEOUT`
+        milliseconds for new events, to wake us up less often.
+        """
+
+        if self.backend.low_power:
+            timeout = max(timeout or 0, LOW_POWER_SYNC_TIMEOUT)
+
+        self.sync_since = since or self.next_batch or self.loaded_sync_token
+        start           = time.monotonic()
+
+        self.sync_request_task = asyncio.current_task()
+
+        try:
+            response = await super().sync(
+                timeout, sync_filter or self.sync_filter, since, full_state,
+            )
+        finally:
+            self.sync_request_task = None
+            self.backend.metrics.observe(
+                "sync_duration_seconds",
+                time.monotonic() - start,
+                account = self.user_id,
+            )
+
+        self._reconnected()
+        return response
+
+
+    async def get_timeout_retry_wait_time(self, got_timeouts: int) -> float:
+        """Wait for the homeserver to be reachable after a sync timeout.
+
+        For syncs, this replaces nio's fixed exponential wait by
+        `_wait_for_homeserver()`, and the returned nio wait time is 0.
+        Other requests keep nio's wait, and fail after its maximum number
+        of timeouts instead of waiting indefinitely for the server.
+        """
+
+        if asyncio.current_task() is not self.sync_request_task:
+            return await super().get_timeout_retry_wait_time(got_timeouts)
+
+        await self._wait_for_homeserver()
+        return 0
+
+
+    async def _wait_for_homeserver(self) -> None:
+        """Wait with backoff and jitter until our homeserver is reachable.
+
+        The backoff is shared with other accounts on the same homeserver,
+        see `HomeserverBackoff`. The reconnection state is exposed in our
+        `Account` model item.
+        """
+
+        backoff = self.backend.homeserver_backoffs[self.homeserver]
+        account = self.models["accounts"].get(self.user_id)
+
+        if self.offline_since is None:
+            self.offline_since = time.monotonic()
+
+            if account:
+                account.offline_since = datetime.now()
+
+        backoff.failed()
+
+        while True:
+            delay = backoff.next_delay()
+
+            if account:
+                account.reconnect_attempts += 1
+                account.next_reconnect      = \
+                    datetime.now() + timedelta(seconds=delay)
+
+            await asyncio.sleep(delay)
+
+            if await backoff.probe(self):
+                return
+
+
+    def _reconnected(self) -> None:
+        """Reset the reconnection state after a successful sync."""
+
+        self.backend.homeserver_backoffs[self.homeserver].succeeded()
+
+        if self.offline_since is None:
+            return
+
+        outage             = time.monotonic() - self.offline_since
+        self.offline_since = None
+
+        metrics = self.backend.metrics
+        metrics.increment("sync_reconnections", account=self.user_id)
+        metrics.observe("sync_outage_seconds", outage, account=self.user_id)
+
+        account = self.models["accounts"].get(self.user_id)
+
+        if account:
+            account.reconnect_attempts = 0
+            account.offline_since      = ZeroDate
+            account.next_reconnect     = ZeroDate
+
+
+    async def create_matrix_response(
+        self,
+        response_class:     Type[nio.Response],
+        transport_response: ClientResponse,
+        data:               Optional[tuple] = None,
+    ) -> nio.Response:
+        """Create nio responses, parse syncs room by room if enabled.
+
+        The size of sync response bodies is also recorded here.
+        """
+
+        is_sync = response_class is nio.SyncResponse
+
+        if is_sync and transport_response.status == 200 and \
+           self.backend.ui_settings["streamSyncResponses"]:
+            response, size = await self._stream_sync_response(
+                transport_response,
+            )
+        else:
+            response = await super().create_matrix_response(
+                response_class, transport_response, data,
+            )
+
+            if not is_sync:
+                return response
+
+            # The body was already read and cached by aiohttp when parsing
+            size = len(await transport_response.read())
+
+        self.backend.metrics.observe(
+            "sync_response_bytes",
+            size,
+            buckets = SIZE_BUCKETS,
+            account = self.user_id,
+        )
+        return response
+
+
+    async def _stream_sync_response(
+        self, transport_response: ClientResponse,
+    ) -> Tuple[nio.Response, int]:
+        """Parse and handle a sync response body one room at a time.
+
+        Rather than decoding the whole body into a dict and then into a
+        `nio.SyncResponse`, every room is decoded and handled by nio and
+        our `onPartialSyncResponse` callback as soon as it is read, which
+        keeps the peak memory usage of huge initial syncs bounded by the
+        size of the largest room instead of the whole account.
+
+        To-device messages are handled before the rooms if they come first
+        in the body, so that room keys they contain can be used to decrypt
+        the rooms' events. Otherwise, the events that couldn't be decrypted
+        are retried when the keys are received.
+
+        nio only updates `next_batch` once the whole response is handled.
+        If the body can't be read to the end, the sync is retried with the
+        same token: timeline events from rooms handled by the failed
+        attempt are then skipped, see `streamed_sync_events`.
+
+        Everything else is returned as a `nio.SyncResponse` without rooms
+        and to-device messages, which will be handled normally when we
+        return.
+        Also return the number of bytes read.
+        """
+
+        stream          = JSONStream(transport_response.content)
+        rest            = {}  # everything except rooms
+        since, streamed = self.streamed_sync_events
+
+        if since != self.sync_since:
+            streamed                  = set()
+            self.streamed_sync_events = (self.sync_since, streamed)
+
+        def part(
+            rooms: Dict[str, Any], to_device: Optional[Dict[str, Any]] = None,
+        ) -> nio.Response:
+            response = nio.SyncResponse.from_dict({
+                "next_batch":                 "",
+                "device_one_time_keys_count": {},
+                "device_lists":               {"changed": [], "left": []},
+                "to_device":                  to_device or {"events": []},
+                "rooms": {"join": {}, "invite": {}, "leave": {}, **rooms},
+            })
+
+            if isinstance(response, nio.ErrorResponse):
+                response.transport_response = transport_response
+                return response
+
+            return nio.PartialSyncResponse(
+                response.next_batch,
+                response.rooms,
+                response.device_key_count,
+                response.device_list,
+                response.to_device_events,
+                unhandled_rooms = {},
+            )
+
+        async def handle_to_device() -> Optional[nio.Response]:
+            if "to_device" not in rest:
+                return None
+
+            to_device         = part({}, rest["to_device"])
+            rest["to_device"] = {"events": []}  # don't let nio handle it again
+
+            if isinstance(to_device, nio.ErrorResponse):
+                return to_device
+
+            await self._handle_to_device(to_device)
+            return None
+
+        async for key in stream.object_items():
+            if key != "rooms":
+                rest[key] = await stream.value()
+                continue
+
+            error = await handle_to_device()
+
+            if error:
+                return (error, stream.read_bytes)
+
+            async for category in stream.object_items():
+                async for room_id in stream.object_items():
+                    room = part({category: {room_id: await stream.value()}})
+
+                    if isinstance(room, nio.ErrorResponse):
+                        return (room, stream.read_bytes)
+
+                    infos = (
+                        *room.rooms.join.values(), *room.rooms.leave.values(),
+                    )
+
+                    for info in infos:
+                        info.timeline.events = [
+                            ev for ev in info.timeline.events
+                            if getattr(ev, "event_id", None) not in streamed
+                        ]
+
+                    await self._handle_invited_rooms(room)
+                    await self._handle_joined_rooms(room)
+                    await self.run_response_callbacks([room])
+
+                    streamed.update(
+                        ev.event_id for info in infos
+                        for ev in info.timeline.events
+                        if getattr(ev, "event_id", None)
+                    )
+
+        error = await handle_to_device()
+
+        if error:
+            return (error, stream.read_bytes)
+
+        self.streamed_sync_events = ("", set())
+
+        response = nio.SyncResponse.from_dict({
+            "to_device": {"events": []},
+            **rest,
+            "rooms": {"join": {}, "invite": {}, "leave": {}},
+        })
+        response.transport_response = transport_response
+        return (response, stream.read_bytes)
+
+
     @staticmethod
     def default_device_name() -> str:
         """Device name to set at login if the user hasn't set a custom one."""
@@ -176,7 +637,9 @@ class MatrixClient(nio.AsyncClient):
         await super().login(
             password, device_name or self.default_device_name(),
         )
-        asyncio.ensure_future(self._start())
+        self.backend.tasks.create(
+            self._start(), "_start", self.user_id, daemon=True,
+        )
 
 
     async def resume(self, user_id: str, token: str, device_id: str) -> None:
@@ -185,23 +648,17 @@ class MatrixClient(nio.AsyncClient):
         response = nio.LoginResponse(user_id, device_id, token)
         await self.receive_response(response)
 
-        asyncio.ensure_future(self._start())
+        self.backend.tasks.create(
+            self._start(), "_start", self.user_id, daemon=True,
+        )
 
 
     async def logout(self) -> None:
         """Logout from the server. This will delete the device."""
 
-        tasks = (
-            self.profile_task, self.load_rooms_task, self.sync_task,
-            self.server_config_task,
-        )
-
-        for task in tasks:
-            if task:
-                task.cancel()
-                with suppress(asyncio.CancelledError):
-                    await task
-
+        await self.backend.tasks.cancel(self.user_id)
+        self.models.end_bulk(self.user_id)
+        self.sync_cache.invalidate()
         await super().logout()
         await self.close()
 
@@ -229,8 +686,10 @@ class MatrixClient(nio.AsyncClient):
 
             if exception:
                 log.warn("On %s client startup: %r", self.user_id, exception)
-                self.profile_task = asyncio.ensure_future(
+                self.profile_task = self.backend.tasks.create(
                     self.backend.get_profile(self.user_id),
+                    "get_profile",
+                    self.user_id,
                 )
                 self.profile_task.add_done_callback(on_profile_response)
                 return
@@ -251,8 +710,10 @@ class MatrixClient(nio.AsyncClient):
 
             if exception:
                 log.warn("On %s client startup: %r", self.user_id, exception)
-                self.server_config_task = asyncio.ensure_future(
+                self.server_config_task = self.backend.tasks.create(
                     self.get_server_config(),
+                    "get_server_config",
+                    self.user_id,
                 )
                 self.server_config_task.add_done_callback(
                     on_server_config_response,
@@ -262,26 +723,61 @@ class MatrixClient(nio.AsyncClient):
             account                 = self.models["accounts"][self.user_id]
             account.max_upload_size = future.result()
 
-        self.profile_task = asyncio.ensure_future(
+        self.profile_task = self.backend.tasks.create(
             self.backend.get_profile(self.user_id),
+            "get_profile",
+            self.user_id,
         )
         self.profile_task.add_done_callback(on_profile_response)
 
-        self.server_config_task = asyncio.ensure_future(
+        self.server_config_task = self.backend.tasks.create(
             self.get_server_config(),
+            "get_server_config",
+            self.user_id,
         )
         self.server_config_task.add_done_callback(on_server_config_response)
 
+        # Until the first sync is done, fill our models without sorting them
+        # on every insertion or sending QML an event for every change
+        self.models.start_bulk(self.user_id)
+
+        # Show rooms restored from the cache right away, even if offline.
+        # The incremental sync that follows is small, no need for bulk mode.
+        if await self.sync_cache.load():
+            self.models.end_bulk(self.user_id)
+
         while True:
             try:
-                self.sync_task = asyncio.ensure_future(
+                self.sync_task = self.backend.tasks.create(
                     self.sync_forever(timeout=10_000),
+                    "sync_forever",
+                    self.user_id,
+                    daemon=True,
                 )
                 await self.sync_task
                 break  # task cancelled
             except Exception as err:
                 trace = traceback.format_exc().rstrip()
 
+                # Only drop the saved state if the server rejected its
+                # sync token, not for e.g. rate limits or network errors
+                resumed_sync_failed = (
+                    isinstance(err, MatrixError) and
+                    (err.m_code == "M_UNKNOWN_POS" or err.http_code == 400) and
+                    self.sync_cache.resumed_token and
+                    not self.first_sync_done.is_set()
+                )
+
+                if resumed_sync_failed:
+                    log.warning(
+                        "Server refused saved sync state for %s, doing a "
+                        "full sync: %r",
+                        self.user_id,
+                        err,
+                    )
+                    await self.sync_cache.discard()
+                    continue
+
                 if isinstance(err, MatrixError) and err.http_code >= 500:
                     log.warning(
                         "Server failure during sync for %s:\n%s",
@@ -291,7 +787,7 @@ class MatrixClient(nio.AsyncClient):
                 else:
                     LoopException(str(err), err, trace)
 
-                await asyncio.sleep(2)
+                await self._wait_for_homeserver()
 
 
     async def get_server_config(self) -> int:
@@ -300,10 +796,21 @@ class MatrixClient(nio.AsyncClient):
 
 
     @property
-    def all_rooms(self) -> Dict[str, nio.MatrixRoom]:
-        """Return dict containing both our joined and invited rooms."""
+    def all_rooms(self) -> Mapping[str, nio.MatrixRoom]:
+        """Return a read-only view of both our joined and invited rooms."""
 
-        return {**self.invited_rooms, **self.rooms}
+        return self._all_rooms_view
+
+
+    def _update_all_rooms(self, room_id: str) -> None:
+        """Update `all_rooms` after nio adds, moves or removes a room."""
+
+        if room_id in self.rooms:
+            self._all_rooms[room_id] = self.rooms[room_id]
+        elif room_id in self.invited_rooms:
+            self._all_rooms[room_id] = self.invited_rooms[room_id]
+        else:
+            self._all_rooms.pop(room_id, None)
 
 
     async def send_text(self, room_id: str, text: str) -> None:
@@ -405,6 +912,10 @@ class MatrixClient(nio.AsyncClient):
         self.upload_monitors[item_uuid] = monitor
         self.upload_tasks[item_uuid]    = asyncio.current_task() # type: ignore
 
+        self.backend.tasks.register(
+            self.upload_tasks[item_uuid], "_send_file", self.user_id, room_id,
+        )
+
         def on_transferred(transferred: int) -> None:
             upload_item.uploaded  = transferred
 
@@ -657,65 +1168,244 @@ class MatrixClient(nio.AsyncClient):
         self.send_message_tasks[transaction_id] = \
             asyncio.current_task()  # type: ignore
 
-        async with self.backend.send_locks[room_id]:
-            await self.room_send(
-                room_id                   = room_id,
-                message_type              = "m.room.message",
-                content                   = content,
-                ignore_unverified_devices = True,
-            )
+        self.backend.tasks.register(
+            self.send_message_tasks[transaction_id],
+            "_send_message",
+            self.user_id,
+            room_id,
+        )
+
+        with self.interactive():
+            async with self.backend.send_locks[room_id]:
+                await self.room_send(
+                    room_id                   = room_id,
+                    message_type              = "m.room.message",
+                    content                   = content,
+                    ignore_unverified_devices = True,
+                )
 
 
     async def load_past_events(self, room_id: str) -> bool:
-        """Ask the server for 100 previous events  of the room.
+        """Load a page of previous events of the room for the user.
+
+        See `_load_past_events()`. The next page is read ahead, and
+        background work yields to this request.
+        """
+
+        with self.interactive():
+            return await self._load_past_events(room_id, read_ahead=True)
+
+
+    async def _load_past_events(
+        self, room_id: str, read_ahead: bool = False,
+    ) -> bool:
+        """Ask the server for a page of previous events of the room.
 
         Events from before the client was started will be requested and
-        registered into our models.
+        registered into our models. See `RoomPager` for how the pages are
+        sized and read ahead, if `read_ahead` is `True`.
+
+        Missing profiles of the page's senders are fetched in parallel,
+        then its events are registered and inserted into the model in one
+        batch. The duration of each step is recorded in the
+        `past_events_step_seconds` metric.
+
+        Only the gaps in our `TimelineGaps` map of the room are requested:
+        once a page reaches events we already hold, loading continues
+        from before them.
 
         Returns whether there are any messages left to load.
         """
 
-        if room_id in self.fully_loaded_rooms or \
-           room_id in self.invited_rooms or \
+        if room_id in self.invited_rooms or \
            room_id in self.cleared_events_rooms:
             return False
 
         await self.first_sync_done.wait()
 
-        while not self.past_tokens.get(room_id):
-            # If a new room was added, wait for onSyncResponse to set the token
+        while room_id not in self.timeline_gaps:
+            # If a new room was added, wait for onSyncResponse to map it
             await asyncio.sleep(0.1)
 
-        response = await self.room_messages(
-            room_id = room_id,
-            start   = self.past_tokens[room_id],
-            limit   = 100 if room_id in self.loaded_once_rooms else 25,
+        gaps = self.timeline_gaps[room_id]
+
+        if gaps.fully_loaded:
+            return False
+
+        if room_id not in self.pagers:
+            self.pagers[room_id] = RoomPager(self, room_id)
+
+        span, older = gaps.next_gap()
+        pager       = self.pagers[room_id]
+        metrics     = self.backend.metrics
+        timed       = partial(
+            metrics.timed, "past_events_step_seconds", account=self.user_id,
         )
 
+        with timed(step="request"):
+            response = await pager.next_page(
+                span.prev_token, older.next_token if older else None,
+                read_ahead,
+            )
+
         self.loaded_once_rooms.add(room_id)
-        more_to_load = True
 
-        self.past_tokens[room_id] = response.end
+        room         = self.all_rooms[room_id]
+        events       = self.models[self.user_id, room_id, "events"]
+        shown_before = len(events)
+        new_events   = [
+            ev for ev in response.chunk
+            if getattr(ev, "event_id", None) not in events
+        ]
+
+        if older and (
+            not response.chunk or
+            response.end == older.next_token or
+            len(new_events) < len(response.chunk)
+        ):
+            gaps.join(span, older)
+            pager.cancel()
+        elif not response.chunk:
+            gaps.extend(span, "")  # nothing older, e.g. no room create event
+        else:
+            gaps.extend(span, response.end)
+
+        with timed(step="senders"):
+            await self._fetch_missing_profiles(room, new_events)
+
+        # Insert the page in one go
+        events.start_bulk()
+
+        try:
+            with timed(step="decode"):
+                for event in new_events:
+                    if isinstance(event, nio.RoomCreateEvent):
+                        gaps.extend(span, "")
+                        pager.cancel()
+
+                    await self.nio_callbacks.dispatch_event(room, event)
+        finally:
+            with timed(step="insert"):
+                events.end_bulk()
+
+        pager.observe_density(len(new_events), len(events) - shown_before)
+
+        with timed(step="rooms"):
+            await self.flush_dirty_rooms()
+
+        return not gaps.fully_loaded
+
+
+    async def _fetch_missing_profiles(
+        self, room: nio.MatrixRoom, events: Sequence[nio.Event],
+    ) -> None:
+        """Fetch in parallel profiles that events registration will need.
+
+        The senders and targets of past events may have left the room,
+        in which case `get_member_name_avatar()` has to request their
+        profile. Request them all at once rather than one event at a time.
+        """
+
+        members  = self.models[self.user_id, room.room_id, "members"]
+        user_ids = {ev.sender for ev in events} | {
+            getattr(ev, "state_key", "") or "" for ev in events
+        }
+
+        missing = [
+            user_id for user_id in user_ids
+            if user_id.startswith("@") and
+            user_id not in members and
+            user_id not in room.users and
+            user_id not in self.backend.profile_cache
+        ]
+
+        await asyncio.gather(
+            *(self.backend.get_profile(user_id) for user_id in missing),
+            return_exceptions = True,
+        )
+
+
+    @contextmanager
+    def interactive(self) -> Iterator[None]:
+        """Mark the duration of a request made for the user.
+
+        Background work, like loading events for rooms without anything
+        to show, waits for `interactive_idle` before each request.
+        """
+
+        self.interactive_requests += 1
+        self.interactive_idle.clear()
+
+        try:
+            yield
+        finally:
+            self.interactive_requests -= 1
+
+            if not self.interactive_requests:
+                self.interactive_idle.set()
 
-        for event in response.chunk:
-            if isinstance(event, nio.RoomCreateEvent):
-                self.fully_loaded_rooms.add(room_id)
-                more_to_load = False
 
-            for cb in self.event_callbacks:
-                if (cb.filter is None or isinstance(event, cb.filter)):
-                    await cb.func(self.all_rooms[room_id], event)
+    async def close_room(self, room_id: str) -> None:
+        """Stop reading past events ahead for a room closed in the UI."""
 
-        return more_to_load
+        pager = self.pagers.get(room_id)
+
+        if pager:
+            pager.cancel()
+
+
+    async def load_all_room_members(self, room_id: str) -> None:
+        """Request the full member list of a room if it wasn't yet loaded.
+
+        Since we sync with lazy-loaded members, a room only knows about
+        members which sent an event we received, until this is called.
+        """
+
+        room = self.all_rooms.get(room_id)
+
+        if not room or room_id in self.invited_rooms or room.members_synced:
+            return
+
+        await self.joined_members(room_id)
+
+        if room_id not in self.all_rooms:  # left or forgotten meanwhile
+            return
+
+        self.mark_all_members_dirty(room)
+        self.invalidate_room_fields(room_id, "m.room.member")
+        await self.register_nio_room(room)
 
 
     async def load_rooms_without_visible_events(self) -> None:
-        """Call `_load_room_without_visible_events` for all joined rooms."""
+        """Call `_load_room_without_visible_events` for all joined rooms.
 
-        for room_id in self.models[self.user_id, "rooms"]:
-            asyncio.ensure_future(
-                self._load_room_without_visible_events(room_id),
-            )
+        Rooms are handled in the order of the room list, by
+        `BACKGROUND_LOADERS` concurrent workers. We're done once every room
+        has been checked, skipping rooms that meanwhile got events to show.
+        """
+
+        rooms   = self.models[self.user_id, "rooms"]
+        pending = deque(room.id for room in sorted(rooms.values()))
+
+        async def worker() -> None:
+            while pending:
+                room_id = pending.popleft()
+
+                if room_id not in self.all_rooms:  # forgotten meanwhile
+                    continue
+
+                # Don't let a failing room stop the other rooms from loading
+                try:
+                    await self._load_room_without_visible_events(room_id)
+                except Exception:
+                    trace = traceback.format_exc().rstrip()
+                    log.warning(
+                        "Failed loading past events for %s:\n%s",
+                        room_id,
+                        trace,
+                    )
+
+        await asyncio.gather(*(worker() for _ in range(BACKGROUND_LOADERS)))
 
 
     async def _load_room_without_visible_events(self, room_id: str) -> None:
@@ -731,14 +1421,17 @@ class MatrixClient(nio.AsyncClient):
 
         This method tries to load past events until we have at least one
         to show or there is nothing left to load.
+        Interactive requests, see `interactive()`, are given priority.
         """
 
         events = self.models[self.user_id, room_id, "events"]
         more   = True
 
         while self.skipped_events[room_id] and not events and more:
+            await self.interactive_idle.wait()
+
             try:
-                more = await self.load_past_events(room_id)
+                more = await self._load_past_events(room_id)
             except MatrixError:
                 break
 
@@ -814,9 +1507,18 @@ class MatrixClient(nio.AsyncClient):
         will be marked as suitable for destruction by the server.
         """
 
+        await self.backend.tasks.cancel(self.user_id, room_id)
+
         self.models[self.user_id, "rooms"].pop(room_id, None)
         self.models.pop((self.user_id, room_id, "events"), None)
         self.models.pop((self.user_id, room_id, "members"), None)
+        self.dirty_members.pop(room_id, None)
+        self.typing_users.pop(room_id, None)
+        self.derived_room_fields.pop(room_id, None)
+        self.pagers.pop(room_id, None)
+        self.timeline_gaps.pop(room_id, None)
+        self.member_events.forget(room_id)
+        self.forget_undecryptable(room_id)
 
         try:
             await super().room_leave(room_id)
@@ -1009,13 +1711,18 @@ class MatrixClient(nio.AsyncClient):
 
         mime = mime or await utils.guess_mime(data_provider(0, 0))
 
-        response, decryption_dict = await super().upload(
-            data_provider,
-            "application/octet-stream" if encrypt else mime,
-            filename,
-            encrypt,
-            monitor,
-        )
+        self.backend.metrics.add("concurrent_uploads", 1)
+
+        try:
+            response, decryption_dict = await super().upload(
+                data_provider,
+                "application/octet-stream" if encrypt else mime,
+                filename,
+                encrypt,
+                monitor,
+            )
+        finally:
+            self.backend.metrics.add("concurrent_uploads", -1)
 
         return UploadReturn(response.content_uri, mime, decryption_dict)
 
@@ -1038,15 +1745,57 @@ class MatrixClient(nio.AsyncClient):
         await self.set_avatar(mxc)
 
 
+    @store_loaded
     async def import_keys(self, infile: str, passphrase: str) -> None:
-        """Import decryption keys from a file, then retry decrypting events."""
+        """Import decryption keys from a file, then retry decrypting events.
+
+        Like nio, the file is decrypted and parsed in a worker thread by
+        `Olm.import_keys_static()`. The sessions are then saved by batches,
+        and the `keys_processed` and `keys_total` fields of our `Account`
+        are updated as progress.
+        Only the events of new sessions that we failed to decrypt are
+        retried.
+        """
 
-        await super().import_keys(infile, passphrase)
-        await self.retry_decrypting_events()
+        account = self.models["accounts"][self.user_id]
+        olm     = self.olm
 
+        sessions = await asyncio.get_event_loop().run_in_executor(
+            None, olm.import_keys_static, infile, passphrase,
+        )
 
+        account.keys_total = len(sessions)
+        new_sessions       = set()
+
+        try:
+            for i in range(0, len(sessions), KEYS_TRANSFER_BATCH):
+                batch = sessions[i:i + KEYS_TRANSFER_BATCH]
+
+                with self.store.database.atomic():
+                    for session in batch:
+                        if olm.inbound_group_store.add(session):
+                            self.store.save_inbound_group_session(session)
+                            new_sessions.add((session.room_id, session.id))
+
+                account.keys_processed = i + len(batch)
+                await asyncio.sleep(0)
+
+            await self.retry_decrypting_events(
+                new_sessions & set(self.undecryptable),
+            )
+        finally:
+            account.keys_processed = account.keys_total = 0
+
+
+    @store_loaded
     async def export_keys(self, outfile: str, passphrase: str) -> None:
-        """Export our decryption keys to a file."""
+        """Export our decryption keys to a file.
+
+        Like nio, the sessions are exported by `Olm.export_keys_static()`,
+        but they are also loaded from the store in the worker thread.
+        The `keys_processed` and `keys_total` fields of our `Account` are
+        updated from there as progress.
+        """
 
         path = Path(outfile)
         path.parent.mkdir(parents=True, exist_ok=True)
@@ -1055,37 +1804,129 @@ class MatrixClient(nio.AsyncClient):
         if path.exists():
             path.unlink()
 
-        await super().export_keys(outfile, passphrase)
+        account = self.models["accounts"][self.user_id]
+        loop    = asyncio.get_event_loop()
+
+        def report(field: str, value: int) -> None:
+            loop.call_soon_threadsafe(setattr, account, field, value)
+
+        def export() -> None:
+            sessions = list(self.store.load_inbound_group_sessions())
+            report("keys_total", len(sessions))
+
+            def counted() -> Iterator[nio.crypto.InboundGroupSession]:
+                for i, session in enumerate(sessions, 1):
+                    yield session
+
+                    if i % KEYS_TRANSFER_BATCH == 0 or i == len(sessions):
+                        report("keys_processed", i)
+
+            self.olm.export_keys_static(counted(), outfile, passphrase)
+
+        try:
+            await loop.run_in_executor(None, export)
+        finally:
+            account.keys_processed = account.keys_total = 0
+
+
+    async def decrypt_megolm_events(
+        self, room_id: str, events: Sequence[nio.MegolmEvent],
+    ) -> List[Optional[nio.Event]]:
+        """Decrypt events of a room, letting other tasks run between chunks.
+
+        Return the decrypted events in the same order as `events`,
+        with `None` for those that couldn't be decrypted.
+
+        Decryption updates the Olm machine's state, e.g. the message indexes
+        used to detect replay attacks and the devices to query keys for,
+        so it must stay in the loop's thread. Big batches are instead
+        split in chunks of `DECRYPTION_CHUNK_SIZE` events, between which
+        the loop can handle syncs and UI calls.
+        """
+
+        if not self.olm or not events:
+            return [None] * len(events)
 
+        results: List[Optional[nio.Event]] = []
+        start                              = time.monotonic()
+        size                               = DECRYPTION_CHUNK_SIZE
 
-    async def retry_decrypting_events(self) -> None:
-        """Retry decrypting room `Event`s in our model we failed to decrypt."""
+        for i in range(0, len(events), size):
+            if i:
+                await asyncio.sleep(0)
 
-        for sync_id, model in self.models.items():
-            if not (isinstance(sync_id, tuple) and
-                    len(sync_id) == 3 and
-                    sync_id[0] == self.user_id and
-                    sync_id[2] == "events"):
+            # The Olm machine may have been closed meanwhile, e.g. on logout
+            if not self.olm:
+                results += [None] * (len(events) - i)
+                break
+
+            chunk    = events[i:i + size]
+            results += [self.olm.decrypt_event(ev, room_id) for ev in chunk]
+
+        metrics = self.backend.metrics
+        metrics.observe("megolm_decryption_seconds", time.monotonic() - start)
+        metrics.increment(
+            "megolm_decrypted_events",
+            len(events) - results.count(None),
+            account = self.user_id,
+        )
+        return results
+
+
+    async def retry_decrypting_events(
+        self, sessions: Optional[Iterable[Tuple[str, str]]] = None,
+    ) -> None:
+        """Retry decrypting room `Event`s in our model we failed to decrypt.
+
+        `sessions` is an iterable of `(room_id, megolm_session_id)` tuples
+        for which we just received keys. If it is `None`, the events for
+        every session in `MatrixClient.undecryptable` are retried.
+        """
+
+        if sessions is None:
+            sessions = list(self.undecryptable)
+
+        for room_id, session_id in sessions:
+            await asyncio.sleep(0)  # let other tasks run between sessions
+
+            event_ids = self.undecryptable.pop((room_id, session_id), set())
+            room      = self.all_rooms.get(room_id)
+            model     = self.models.get((self.user_id, room_id, "events"))
+
+            if not room or model is None:
                 continue
 
-            _, room_id, _ = sync_id
+            items = sorted(
+                (
+                    model[event_id] for event_id in event_ids
+                    if event_id in model and
+                    isinstance(model[event_id].source, nio.MegolmEvent)
+                ),
+                key = lambda item: item.date,
+            )
 
-            for ev in model.copy().values():
-                room = self.all_rooms[room_id]
+            decrypted = await self.decrypt_megolm_events(
+                room_id, [item.source for item in items],
+            )
 
-                if isinstance(ev.source, nio.MegolmEvent):
-                    try:
-                        decrypted = self.decrypt_event(ev.source)
+            for item, event in zip(items, decrypted):
+                if model.get(item.id) is not item:
+                    continue  # redacted or removed while we were decrypting
 
-                        if not decrypted:
-                            raise nio.EncryptionError()
+                if not event:
+                    self.undecryptable[room_id, session_id].add(item.id)
+                    continue
 
-                    except nio.EncryptionError:
-                        continue
+                await self.nio_callbacks.dispatch_event(room, event)
 
-                    for cb in self.event_callbacks:
-                        if not cb.filter or isinstance(decrypted, cb.filter):
-                            await asyncio.coroutine(cb.func)(room, decrypted)
+        await self.flush_dirty_rooms()
+
+
+    def forget_undecryptable(self, room_id: str) -> None:
+        """Remove a room's events from `MatrixClient.undecryptable`."""
+
+        for key in [k for k in self.undecryptable if k[0] == room_id]:
+            del self.undecryptable[key]
 
 
     async def clear_events(self, room_id: str) -> None:
@@ -1095,6 +1936,8 @@ class MatrixClient(nio.AsyncClient):
         """
 
         self.cleared_events_rooms.add(room_id)
+        self.member_events.forget(room_id)
+        self.forget_undecryptable(room_id)
 
         model = self.models[self.user_id, room_id, "events"]
         if model:
@@ -1130,16 +1973,60 @@ class MatrixClient(nio.AsyncClient):
             room.last_event_date = item.date
 
 
+    def clear_typing(self) -> None:
+        """Mark everyone as not typing, for when typing notices are ignored.
+        """
+
+        rooms = self.models[self.user_id, "rooms"]
+
+        for room_id, user_ids in self.typing_users.items():
+            if room_id in rooms:
+                rooms[room_id].typing_members = []
+
+            members = self.models[self.user_id, room_id, "members"]
+
+            for user_id in user_ids:
+                if user_id in members:
+                    members[user_id].typing = False
+
+        self.typing_users.clear()
+
+
+    async def mark_room_dirty(self, room: nio.MatrixRoom) -> None:
+        """Schedule a `nio.MatrixRoom` to be registered again in our model.
+
+        Rebuilding a `Room` and its members is costly, rooms are marked
+        while processing a batch of events and only registered once by
+        `flush_dirty_rooms()` at the end.
+        Rooms that aren't registered yet are registered right away,
+        since the processed events need their `Room` item to exist.
+        """
+
+        if room.room_id in self.models[self.user_id, "rooms"]:
+            self.dirty_rooms.add(room.room_id)
+        else:
+            await self.register_nio_room(room)
+
+
+    async def flush_dirty_rooms(self) -> None:
+        """Register rooms marked by `mark_room_dirty()` in our model."""
+
+        while self.dirty_rooms:
+            room_id = self.dirty_rooms.pop()
+
+            if room_id in self.all_rooms:
+                await self.register_nio_room(self.all_rooms[room_id])
+
+
     async def register_nio_room(
         self, room: nio.MatrixRoom, left: bool = False,
     ) -> None:
         """Register a `nio.MatrixRoom` as a `Room` object in our model."""
 
-        # Add room
-        inviter        = getattr(room, "inviter", "") or ""
-        levels         = room.power_levels
-        can_send_state = partial(levels.can_user_send_state, self.user_id)
-        can_send_msg   = partial(levels.can_user_send_message, self.user_id)
+        self.dirty_rooms.discard(room.room_id)
+
+        start   = time.perf_counter()
+        inviter = getattr(room, "inviter", "") or ""
 
         try:
             registered      = self.models[self.user_id, "rooms"][room.room_id]
@@ -1153,13 +2040,6 @@ class MatrixClient(nio.AsyncClient):
 
         self.models[self.user_id, "rooms"][room.room_id] = Room(
             id             = room.room_id,
-            given_name     = room.name or "",
-            display_name   = room.display_name or "",
-            avatar_url     = room.gen_avatar_url or "",
-            plain_topic    = room.topic or "",
-            topic          = HTML.filter(
-                room.topic or "", inline=True, room_id=room.room_id,
-            ),
             inviter_id     = inviter,
             inviter_name   = room.user_name(inviter) if inviter else "",
             inviter_avatar =
@@ -1172,50 +2052,162 @@ class MatrixClient(nio.AsyncClient):
             invite_required = room.join_rule == "invite",
             guests_allowed  = room.guest_access == "can_join",
 
-            can_invite           = levels.can_user_invite(self.user),
-            can_redact_all       = levels.can_user_redact(self.user),
-            can_send_messages    = can_send_msg(),
-            can_set_name         = can_send_state("m.room.name"),
-            can_set_topic        = can_send_state("m.room.topic"),
-            can_set_avatar       = can_send_state("m.room.avatar"),
-            can_set_encryption   = can_send_state("m.room.encryption"),
-            can_set_join_rules   = can_send_state("m.room.join_rules"),
-            can_set_guest_access = can_send_state("m.room.guest_access"),
-
             last_event_date = last_event_date,
             mentions        = mentions,
 
+            **self._derived_room_fields(room),
         )
 
-        # List members that left the room, then remove them from our model
-        left_the_room = [
-            user_id
-            for user_id in self.models[self.user_id, room.room_id, "members"]
-            if user_id not in room.users
-        ]
+        self.backend.metrics.observe(
+            "room_registration_seconds", time.perf_counter() - start,
+        )
+
+        await self._register_room_members(room)
 
-        for user_id in left_the_room:
-            del self.models[self.user_id, room.room_id, "members"][user_id]
-            HTML.rooms_user_id_names[room.room_id].pop(user_id, None)
 
-        # Add the room members to the added room
-        new_dict = {
-            user_id: Member(
+    def _derived_room_fields(self, room: nio.MatrixRoom) -> Dict[str, Any]:
+        """Return `Room` fields derived from a room's state, using our cache.
+
+        Field groups are computed if they aren't in `derived_room_fields`,
+        and stay cached until `invalidate_room_fields()` is called with an
+        event type they depend on.
+        Topics aren't invalidated by member events to keep this cache
+        effective in big rooms, even if member names can be linkified in it.
+        """
+
+        def permissions() -> Dict[str, Any]:
+            levels         = room.power_levels
+            can_send_state = partial(levels.can_user_send_state, self.user_id)
+
+            return {
+                "can_invite":        levels.can_user_invite(self.user),
+                "can_redact_all":    levels.can_user_redact(self.user),
+                "can_send_messages":
+                    levels.can_user_send_message(self.user_id),
+
+                "can_set_name":         can_send_state("m.room.name"),
+                "can_set_topic":        can_send_state("m.room.topic"),
+                "can_set_avatar":       can_send_state("m.room.avatar"),
+                "can_set_encryption":   can_send_state("m.room.encryption"),
+                "can_set_join_rules":   can_send_state("m.room.join_rules"),
+                "can_set_guest_access": can_send_state("m.room.guest_access"),
+            }
+
+        def name() -> Dict[str, Any]:
+            return {
+                "given_name":   room.name or "",
+                "display_name": room.display_name or "",
+            }
+
+        def avatar() -> Dict[str, Any]:
+            return {"avatar_url": room.gen_avatar_url or ""}
+
+        def topic() -> Dict[str, Any]:
+            return {
+                "plain_topic": room.topic or "",
+                "topic":       HTML.filter(
+                    room.topic or "", inline=True, room_id=room.room_id,
+                ),
+            }
+
+        cache  = self.derived_room_fields.setdefault(room.room_id, {})
+        fields = {}
+
+        for group in (permissions, name, avatar, topic):
+            if group.__name__ in cache:
+                result = "hit"
+            else:
+                result                = "miss"
+                cache[group.__name__] = group()
+
+            self.backend.metrics.increment(
+                "room_fields_cache", group=group.__name__, result=result,
+            )
+            fields.update(cache[group.__name__])
+
+        return fields
+
+
+    def invalidate_room_fields(self, room_id: str, *event_types: str) -> None:
+        """Drop cached `Room` fields that depend on these state event types.
+        """
+
+        cache = self.derived_room_fields.get(room_id)
+
+        if not cache:
+            return
+
+        for event_type in event_types:
+            for group in ROOM_FIELDS_DEPENDENCIES.get(event_type, ()):
+                cache.pop(group, None)
+
+
+    def mark_members_dirty(self, room_id: str, *user_ids: str) -> None:
+        """Schedule room members to be updated on next room registration."""
+
+        self.dirty_members[room_id].update(user_ids)
+
+
+    def mark_all_members_dirty(self, room: nio.MatrixRoom) -> None:
+        """Schedule all members of a room to be updated.
+
+        This is needed when something affecting every member changed,
+        e.g. the power levels, or when the full member list was loaded.
+        """
+
+        self.mark_members_dirty(
+            room.room_id,
+            *room.users,
+            *self.models[self.user_id, room.room_id, "members"],
+        )
+
+
+    async def _register_room_members(self, room: nio.MatrixRoom) -> None:
+        """Update `Member` items of a room marked by `mark_members_dirty()`.
+
+        Members that left the room are removed from our model.
+        Only the members sharing the old or new display name of a changed
+        member are re-disambiguated, other members are left untouched.
+        If the room has no members in our model yet, all are registered.
+        """
+
+        room_id = room.room_id
+        model   = self.models[self.user_id, room_id, "members"]
+        names   = HTML.rooms_user_id_names[room_id]
+        dirty   = self.dirty_members.pop(room_id, set())
+
+        if not model:
+            dirty.update(room.users)
+
+        for user_id in tuple(dirty):
+            user = room.users.get(user_id)
+
+            for name in (names.get(user_id), user and user.display_name):
+                if name:
+                    dirty.update(room.names.get(name, ()))
+
+        for user_id in dirty:
+            user = room.users.get(user_id)
+
+            if not user:
+                model.pop(user_id, None)
+                names.pop(user_id, None)
+                continue
+
+            model[user_id] = Member(
                 id           = user_id,
                 display_name = room.user_name(user_id)  # disambiguated
-                               if member.display_name else "",
-                avatar_url   = member.avatar_url or "",
+                               if user.display_name else "",
+                avatar_url   = user.avatar_url or "",
                 typing       = user_id in room.typing_users,
-                power_level  = member.power_level,
-                invited      = member.invited,
-            ) for user_id, member in room.users.items()
-        }
-        self.models[self.user_id, room.room_id, "members"].update(new_dict)
+                power_level  = user.power_level,
+                invited      = user.invited,
+            )
 
-        for user_id, member in room.users.items():
-            if member.display_name:
-                HTML.rooms_user_id_names[room.room_id][user_id] = \
-                    member.display_name
+            if user.display_name:
+                names[user_id] = user.display_name
+            else:
+                names.pop(user_id, None)
 
 
     async def get_member_name_avatar(
@@ -1223,14 +2215,24 @@ class MatrixClient(nio.AsyncClient):
     ) -> Tuple[str, str]:
         """Return a room member's display name and avatar.
 
-        If the member isn't found in the room (e.g. they left), their
+        If the member isn't in our model yet, e.g. because the room
+        registration is pending in `dirty_rooms`, the nio room is checked.
+        If they aren't found in the room either (e.g. they left), their
         profile is retrieved using `MatrixClient.backend.get_profile()`.
         """
 
         try:
             item = self.models[self.user_id, room_id, "members"][user_id]
 
-        except KeyError:  # e.g. user is not anymore in the room
+        except KeyError:
+            room = self.all_rooms.get(room_id)
+
+            if room and user_id in room.users:
+                user = room.users[user_id]
+                name = room.user_name(user_id) if user.display_name else ""
+                return (name, user.avatar_url or "")
+
+            # e.g. user is not anymore in the room
             try:
                 info = await self.backend.get_profile(user_id)
                 return (info.displayname or "", info.avatar_url or "")
@@ -1251,7 +2253,10 @@ class MatrixClient(nio.AsyncClient):
     ) -> None:
         """Register a `nio.Event` as a `Event` object in our model."""
 
-        await self.register_nio_room(room)
+        if isinstance(ev.source, dict) and "state_key" in ev.source:
+            self.invalidate_room_fields(room.room_id, ev.source.get("type"))
+
+        await self.mark_room_dirty(room)
 
         sender_name, sender_avatar = \
             await self.get_member_name_avatar(room.room_id, ev.sender)
@@ -1262,8 +2267,12 @@ class MatrixClient(nio.AsyncClient):
             await self.get_member_name_avatar(room.room_id, target_id) \
             if target_id else ("", "")
 
+        date    = datetime.fromtimestamp(ev.server_timestamp / 1000)
         content = fields.get("content", "").strip()
 
+        if not isinstance(ev, nio.RoomMemberEvent):
+            self.member_events.break_runs(room.room_id, date)
+
         if content and "inline_content" not in fields:
             fields["inline_content"] = HTML.filter(
                 content, inline=True, room_id=room.room_id,
@@ -1276,7 +2285,7 @@ class MatrixClient(nio.AsyncClient):
             event_id      = ev.event_id,
             event_type    = type(ev),
             source        = ev,
-            date          = datetime.fromtimestamp(ev.server_timestamp / 1000),
+            date          = date,
             sender_id     = ev.sender,
             sender_name   = sender_name,
             sender_avatar = sender_avatar,
@@ -10,7 +10,7 @@ import shutil
 import sys
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, DefaultDict, Dict, Optional
+from typing import TYPE_CHECKING, Any, ClassVar, DefaultDict, Dict, Optional
 from urllib.parse import urlparse
 
 from PIL import Image as PILImage
@@ -52,10 +52,15 @@ class MediaCache:
         mxc:        str,
         title:      str,
         crypt_dict: CryptDict = None,
+        background: bool      = True,
     ) -> Path:
-        """Return a `Media` object. Method intended for QML convenience."""
+        """Return a `Media` object. Method intended for QML convenience.
 
-        return await Media(self, mxc, title, crypt_dict).get()
+        `background` should be `False` for downloads requested by the user,
+        which don't wait for the low-power mode to be disabled.
+        """
+
+        return await Media(self, mxc, title, crypt_dict).get(background)
 
 
     async def get_thumbnail(
@@ -85,6 +90,9 @@ class Media:
     crypt_dict: CryptDict    = field(repr=False)
 
 
+    kind: ClassVar[str] = "media"
+
+
     def __post_init__(self) -> None:
         self.mxc = re.sub(r"#auto$", "", self.mxc)
 
@@ -111,14 +119,30 @@ class Media:
         return self.cache.downloads_dir / parsed.netloc / filename
 
 
-    async def get(self) -> Path:
-        """Return the cached file's path, downloading it first if needed."""
+    async def get(self, background: bool = True) -> Path:
+        """Return the cached file's path, downloading it first if needed.
 
-        async with ACCESS_LOCKS[self.mxc]:
-            try:
-                return await self._get_local_existing_file()
-            except FileNotFoundError:
-                return await self.create()
+        If `background` is `True`, downloads wait for the low-power mode
+        to be disabled.
+        """
+
+        metrics    = self.cache.backend.metrics
+        foreground = self.cache.backend.foreground
+
+        while True:
+            async with ACCESS_LOCKS[self.mxc]:
+                try:
+                    path = await self._get_local_existing_file()
+                except FileNotFoundError:
+                    if foreground.is_set() or not background:
+                        metrics.increment("media_cache_misses", kind=self.kind)
+                        return await self.create()
+                else:
+                    metrics.increment("media_cache_hits", kind=self.kind)
+                    return path
+
+            # Wait without holding the lock, which user downloads may need
+            await foreground.wait()
 
 
     async def _get_local_existing_file(self) -> Path:
@@ -133,8 +157,19 @@ class Media:
     async def create(self) -> Path:
         """Download and cache the media file to disk."""
 
+        metrics = self.cache.backend.metrics
+
         async with CONCURRENT_DOWNLOADS_LIMIT:
-            data = await self._get_remote_data()
+            metrics.add("concurrent_downloads", 1)
+
+            try:
+                data = await self._get_remote_data()
+            finally:
+                metrics.add("concurrent_downloads", -1)
+
+        metrics.increment(
+            "media_cache_downloaded_bytes", len(data), kind=self.kind,
+        )
 
         self.local_path.parent.mkdir(parents=True, exist_ok=True)
 
@@ -226,6 +261,8 @@ class Media:
 class Thumbnail(Media):
     """The thumbnail of a matrix media, which is a media itself."""
 
+    kind: ClassVar[str] = "thumbnail"
+
     cache:       "MediaCache" = field()
     mxc:         str          = field()
     title:       str          = field()
@@ -0,0 +1,416 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Backend metrics collection and export in the OpenMetrics text format."""
+
+import asyncio
+import logging as log
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING, Any, DefaultDict, Dict, Iterator, List, Optional, Tuple,
+)
+
+if TYPE_CHECKING:
+    from .backend import Backend
+
+Labels = Tuple[Tuple[str, str], ...]
+
+DURATION_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)
+
+SIZE_BUCKETS = (
+    1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864,
+)
+
+
+@dataclass
+class Histogram:
+    """Count of observed values falling in predefined buckets."""
+
+    buckets: Tuple[float, ...] = DURATION_BUCKETS
+    counts:  List[int]         = field(init=False)
+    sum:     float             = 0
+    count:   int               = 0
+
+
+    def __post_init__(self) -> None:
+        self.counts = [0] * len(self.buckets)
+
+
+    def observe(self, value: float) -> None:
+        """Record a value in the first bucket where it fits."""
+
+        index = bisect_left(self.buckets, value)
+
+        if index < len(self.counts):
+            self.counts[index] += 1
+
+        self.sum   += value
+        self.count += 1
+
+
+    @property
+    def serialized(self) -> Dict[str, Any]:
+        return {"count": self.count, "sum": self.sum}
+
+
+@dataclass
+class Metrics:
+    """Counters, gauges and histograms describing the backend's health.
+
+    Metric names are given without the `mirage_` prefix and counter
+    `_total` suffix, which are added when rendering the OpenMetrics text.
+    Label keyword arguments can be passed to the recording methods to
+    have multiple values for a metric, e.g. one per account.
+
+    Recording is meant to be cheap enough for metrics to always be collected.
+    Values that can be read from other objects at any time, such as
+    model item counts, are computed by `Backend.get_stats()` instead.
+    """
+
+    help: Dict[str, str] = field(default_factory=lambda: {
+        "loop_lag_seconds":
+            "Delay of the asyncio loop in running a scheduled callback",
+        "loop_lag_distribution_seconds":
+            "Distribution of the asyncio loop lag measurements",
+        "pending_bridge_calls": "Coroutines called by QML still running",
+        "models":               "Number of models in the model store",
+        "model_items":          "Number of items in the models",
+        "media_cache_hits":     "Media files found in the disk cache",
+        "media_cache_misses":   "Media files that had to be downloaded",
+        "media_cache_downloaded_bytes": "Size of the downloaded media files",
+        "concurrent_downloads": "Media downloads currently running",
+        "concurrent_uploads":   "File uploads currently running",
+        "sync_duration_seconds":  "Time taken by sync requests",
+        "sync_response_bytes":    "Size of the sync response bodies",
+        "matrix_errors":          "Errors returned by the Matrix servers",
+        "sync_reconnections":
+            "Syncs that succeeded after connection failures",
+        "sync_outage_seconds":
+            "Time between a sync connection failure and the next success",
+        "homeserver_failures":
+            "Consecutive connection failures counted in a homeserver backoff",
+        "low_power_mode":
+            "Whether the low-power mode for an inactive UI is enabled",
+        "room_registration_seconds":
+            "Time taken to build a Room item from a nio room",
+        "room_fields_cache":
+            "Lookups in the cache of fields derived from room state",
+        "megolm_decryption_seconds":
+            "Time taken to decrypt batches of encrypted room events",
+        "megolm_decrypted_events": "Encrypted room events decrypted",
+        "past_events_step_seconds":
+            "Time taken by each step of loading a page of past events",
+        "nio_handler_seconds":
+            "Time taken by each nio response and event handler",
+        "sync_handler_seconds":
+            "Time spent in each handler for the last sync response",
+        "sync_handlers_seconds":
+            "Total time spent in handlers for each sync response",
+        "background_tasks":       "Running tasks in the task registry",
+        "lock_table_entries":     "Number of locks in the lock tables",
+        "gc_pause_seconds":       "Duration of garbage collections",
+        "gc_collected_objects":   "Objects freed by garbage collections",
+        "gc_threshold":           "Garbage collector generation thresholds",
+        "gc_pending_objects":
+            "Allocations or collections counted toward the next collection",
+        "gc_frozen_objects":
+            "Objects in the permanent generation ignored by collections",
+        "gc_full_collection_seconds":
+            "Duration of a full garbage collection before and after freezing",
+        "metrics_export_duration_seconds":
+            "Time taken to answer metrics scraping requests",
+    })
+
+    counters: DefaultDict[str, DefaultDict[Labels, float]] = field(
+        default_factory=lambda: DefaultDict(lambda: DefaultDict(float)),
+    )
+
+    gauges: DefaultDict[str, DefaultDict[Labels, float]] = field(
+        default_factory=lambda: DefaultDict(lambda: DefaultDict(float)),
+    )
+
+    histograms: DefaultDict[str, Dict[Labels, Histogram]] = field(
+        default_factory=lambda: DefaultDict(dict),
+    )
+
+
+    @staticmethod
+    def _labels(labels: Dict[str, Any]) -> Labels:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+    def increment(self, name: str, amount: float = 1, **labels) -> None:
+        """Increase the value of a counter."""
+
+        self.counters[name][self._labels(labels)] += amount
+
+
+    def set(self, name: str, value: float, **labels) -> None:
+        """Set the value of a gauge."""
+
+        self.gauges[name][self._labels(labels)] = value
+
+
+    def add(self, name: str, amount: float, **labels) -> None:
+        """Increase or decrease the value of a gauge."""
+
+        self.gauges[name][self._labels(labels)] += amount
+
+
+    def observe(
+        self,
+        name:    str,
+        value:   float,
+        buckets: Tuple[float, ...] = DURATION_BUCKETS,
+        **labels,
+    ) -> None:
+        """Record a value in a histogram, create it with `buckets` if needed.
+        """
+
+        key = self._labels(labels)
+
+        if key not in self.histograms[name]:
+            self.histograms[name][key] = Histogram(buckets)
+
+        self.histograms[name][key].observe(value)
+
+
+    @contextmanager
+    def timed(self, name: str, **labels) -> Iterator[None]:
+        """Observe the duration of a `with` block in a histogram."""
+
+        start = time.monotonic()
+
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+
+    def _gauges(
+        self, extra_gauges: Optional[Dict[str, Dict[Labels, float]]] = None,
+    ) -> Dict[str, Dict[Labels, float]]:
+        return {**self.gauges, **(extra_gauges or {})}
+
+
+    async def monitor_loop_lag(
+        self, active: asyncio.Event, interval: float = 1,
+    ) -> None:
+        """Measure how late the asyncio loop wakes us up, forever.
+
+        Measurements are paused while the `active` event is cleared,
+        e.g. during the low-power mode.
+        """
+
+        loop = asyncio.get_event_loop()
+
+        while True:
+            await active.wait()
+
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+
+            lag = max(0, loop.time() - expected)
+            self.set("loop_lag_seconds", lag)
+            self.observe("loop_lag_distribution_seconds", lag)
+
+
+    def as_dict(
+        self, extra_gauges: Optional[Dict[str, Dict[Labels, float]]] = None,
+    ) -> Dict[str, Any]:
+        """Return a JSON-compatible `{metric: {labels: value}}` dict.
+
+        `extra_gauges` is a `{name: {labels: value}}` dict of gauges computed
+        by the caller, which will be included in the returned dict.
+        """
+
+        def labels_str(labels: Labels) -> str:
+            return ",".join(f"{k}={v}" for k, v in labels)
+
+        data: Dict[str, Any] = {}
+        kinds                = (
+            self.counters, self._gauges(extra_gauges), self.histograms,
+        )
+
+        for kind in kinds:
+            for name, values in kind.items():
+                data[name] = {
+                    labels_str(labels): getattr(value, "serialized", value)
+                    for labels, value in values.items()
+                }
+
+        return data
+
+
+    def render(
+        self, extra_gauges: Optional[Dict[str, Dict[Labels, float]]] = None,
+    ) -> str:
+        """Return all metrics in the OpenMetrics text exposition format.
+
+        `extra_gauges` has the same meaning as for `Metrics.as_dict()`.
+        """
+
+        def escape(value: str) -> str:
+            return value.replace("\\", r"\\").replace("\n", r"\n") \
+                        .replace('"', r'\"')
+
+        def sample(name: str, labels: Labels, value: float) -> str:
+            if not labels:
+                return f"{name} {value}"
+
+            pairs = ",".join(f'{k}="{escape(v)}"' for k, v in labels)
+            return f"{name}{{{pairs}}} {value}"
+
+        lines: List[str] = []
+
+        def header(name: str, kind: str) -> str:
+            full_name = f"mirage_{name}"
+            lines.append(f"# TYPE {full_name} {kind}")
+
+            if name in self.help:
+                lines.append(f"# HELP {full_name} {escape(self.help[name])}")
+
+            return full_name
+
+        for name, values in sorted(self.counters.items()):
+            full_name = header(name, "counter")
+
+            for labels, value in values.items():
+                lines.append(sample(f"{full_name}_total", labels, value))
+
+        for name, values in sorted(self._gauges(extra_gauges).items()):
+            full_name = header(name, "gauge")
+
+            for labels, value in values.items():
+                lines.append(sample(full_name, labels, value))
+
+        for name, histograms in sorted(self.histograms.items()):
+            full_name = header(name, "histogram")
+
+            for labels, histo in histograms.items():
+                cumulated = 0
+
+                for bucket, count in zip(histo.buckets, histo.counts):
+                    cumulated += count
+                    le         = (("le", str(float(bucket))),)
+                    lines.append(
+                        sample(f"{full_name}_bucket", labels + le, cumulated),
+                    )
+
+                inf = (("le", "+Inf"),)
+                lines.append(
+                    sample(f"{full_name}_bucket", labels + inf, histo.count),
+                )
+                lines.append(sample(f"{full_name}_count", labels, histo.count))
+                lines.append(sample(f"{full_name}_sum", labels, histo.sum))
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+@dataclass
+class MetricsExporter:
+    """Serve the backend's metrics over HTTP for local scrapers.
+
+    The `address` can be a `unix:<path>` socket, or a `<host>:<port>`
+    or `<port>` TCP address. For privacy, only loopback hosts are accepted.
+    An empty address means the exporter is disabled.
+    """
+
+    backend: "Backend" = field(repr=False)
+    address: str       = ""
+
+    _server: Optional[asyncio.AbstractServer] = field(
+        init=False, repr=False, default=None,
+    )
+
+
+    async def apply(self, address: str) -> None:
+        """Start, restart or stop the server to match a new address."""
+
+        address = address.strip()
+
+        if address == self.address and (self._server or not address):
+            return
+
+        await self.stop()
+        self.address = address
+
+        if not address:
+            return
+
+        try:
+            if address.startswith("unix:"):
+                path = Path(address[len("unix:"):]).expanduser()
+
+                if path.is_socket():
+                    path.unlink()
+
+                self._server = await asyncio.start_unix_server(
+                    self._handle_client, str(path),
+                )
+            else:
+                host, _, port = address.rpartition(":")
+                host          = host.strip("[]") or "127.0.0.1"
+
+                if host not in ("127.0.0.1", "::1", "localhost"):
+                    raise ValueError(f"{host} is not a loopback address")
+
+                self._server = await asyncio.start_server(
+                    self._handle_client, host, int(port),
+                )
+
+        except (OSError, ValueError) as err:
+            log.warning("Can't serve metrics on %r: %r", address, err)
+        else:
+            log.info("Serving OpenMetrics on %s", address)
+
+
+    async def stop(self) -> None:
+        """Stop the server if it is running."""
+
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+    async def _handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+    ) -> None:
+        """Answer any HTTP request with the current metrics."""
+
+        start = time.monotonic()
+
+        async def skip_request() -> None:
+            # Wait for the end of the request's headers, which we don't need
+            while (await reader.readline()).strip():
+                pass
+
+        try:
+            await asyncio.wait_for(skip_request(), timeout=10)
+            body = (await self.backend.get_metrics()).encode()
+
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: application/openmetrics-text; "
+                b"version=1.0.0; charset=utf-8\r\n"
+                b"Content-Length: %d\r\n"
+                b"Connection: close\r\n\r\n" % len(body),
+            )
+            writer.write(body)
+            await writer.drain()
+
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+
+        finally:
+            writer.close()
+            self.backend.metrics.observe(
+                "metrics_export_duration_seconds", time.monotonic() - start,
+            )
@@ -39,6 +39,14 @@ class Account(ModelItem):
     profile_updated: datetime = ZeroDate
     first_sync_done: bool     = False
 
+    reconnect_attempts: int      = 0
+    offline_since:      datetime = ZeroDate
+    next_reconnect:     datetime = ZeroDate
+
+    # Decryption keys processed by a running import or export
+    keys_processed: int = 0
+    keys_total:     int = 0
+
     def __lt__(self, other: "Account") -> bool:
         """Sort by display name or user ID."""
         name       = self.display_name or self.id[1:]
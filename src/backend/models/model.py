@@ -1,21 +1,30 @@
 # SPDX-License-Identifier: LGPL-3.0-or-later
 
+import sys
 from bisect import bisect
 from threading import RLock
 from typing import (
-    TYPE_CHECKING, Any, Dict, Iterator, List, MutableMapping, Optional,
+    TYPE_CHECKING, Any, Dict, Iterator, List, MutableMapping, Optional, Set,
+    Tuple, Type,
 )
 
 from blist import blist
 
 from ..pyotherside_events import (
-    ModelCleared, ModelItemDeleted, ModelItemInserted,
+    ModelCleared, ModelItemDeleted, ModelItemInserted, ModelItemsInserted,
+    ModelSnapshot, PyOtherSideEvent,
 )
+from ..utils import deep_sizeof
 from . import SyncId
 
 if TYPE_CHECKING:
     from .model_item import ModelItem
 
+DeferredEvent = Tuple[Type[PyOtherSideEvent], tuple]
+
+# Deferred events kept per model before replacing them by a single snapshot
+MAX_DEFERRED_EVENTS = 500
+
 
 class Model(MutableMapping):
     """A mapping of `{ModelItem.id: ModelItem}` synced between Python & QML.
@@ -29,6 +38,19 @@ class Model(MutableMapping):
     QML of the changes so that it can keep its models in sync.
 
     Items in the model are kept sorted using the `ModelItem` subclass `__lt__`.
+
+    While in bulk mode (see `start_bulk()`), items are stored unsorted and no
+    event is fired. `end_bulk()` sorts the items once and sends QML
+    what changed in the meantime: a `ModelItemsInserted` event for each
+    run of consecutive new items if items were only added, else the whole
+    model content in a single `ModelSnapshot` event.
+    Bulk mode can be nested: it only ends when `end_bulk()` has been called
+    as many times as `start_bulk()`.
+
+    While events are deferred (see `defer_events()`), the model is kept
+    up to date as usual, but its events are queued instead of being sent.
+    If more than `MAX_DEFERRED_EVENTS` are queued, they are dropped and
+    the whole model content is sent in a `ModelSnapshot` instead.
     """
 
     def __init__(self, sync_id: Optional[SyncId]) -> None:
@@ -36,6 +58,17 @@ class Model(MutableMapping):
         self._data:        Dict[Any, "ModelItem"] = {}
         self._sorted_data: List["ModelItem"]      = blist()
         self._write_lock:  RLock                  = RLock()
+        self.bulk:         int                    = 0
+        self.bulk_changed: bool                   = False
+
+        # {id(item): item} of the items inserted while in bulk mode
+        self._bulk_inserted: Dict[int, "ModelItem"] = {}
+
+        # (event type, args) to send when events are no longer deferred
+        self.deferred_events: Optional[List[DeferredEvent]] = None
+
+        # Whether too many events were deferred and a snapshot must be sent
+        self._deferred_overflow: bool = False
 
 
     def __repr__(self) -> str:
@@ -86,11 +119,17 @@ class Model(MutableMapping):
                 new.parent_model = self
 
             self._data[key] = new
-            index           = bisect(self._sorted_data, new)
+
+            if self.bulk:
+                self._sorted_data.append(new)
+                self._bulk_inserted[id(new)] = new
+                return
+
+            index = bisect(self._sorted_data, new)
             self._sorted_data.insert(index, new)
 
             if self.sync_id:
-                ModelItemInserted(self.sync_id, index, new)
+                self.send(ModelItemInserted, self.sync_id, index, new)
 
 
     def __delitem__(self, key) -> None:
@@ -102,8 +141,10 @@ class Model(MutableMapping):
             index = self._sorted_data.index(item)
             del self._sorted_data[index]
 
-            if self.sync_id:
-                ModelItemDeleted(self.sync_id, index)
+            if self.bulk:
+                self.bulk_changed = True
+            elif self.sync_id:
+                self.send(ModelItemDeleted, self.sync_id, index)
 
 
     def __iter__(self) -> Iterator:
@@ -121,8 +162,189 @@ class Model(MutableMapping):
 
     def clear(self) -> None:
         super().clear()
-        if self.sync_id:
-            ModelCleared(self.sync_id)
+
+        if self.bulk:
+            self.bulk_changed = True
+        elif self.sync_id:
+            self.send(ModelCleared, self.sync_id)
+
+
+    def start_bulk(self) -> None:
+        """Stop sorting items and sending events until `end_bulk()`."""
+
+        self.bulk += 1
+
+
+    def end_bulk(self) -> None:
+        """Sort the items and send QML what changed while in bulk mode."""
+
+        with self._write_lock:
+            if not self.bulk:
+                return
+
+            self.bulk -= 1
+
+            if self.bulk:
+                return
+
+            inserted            = self._bulk_inserted
+            self._bulk_inserted = {}
+
+            if not inserted and not self.bulk_changed:
+                return
+
+            self._sorted_data = blist(sorted(self._sorted_data))
+
+            if self.sync_id and self.bulk_changed:
+                self.send(
+                    ModelSnapshot,
+                    self.sync_id,
+                    [item.serialized for item in self._sorted_data],
+                )
+
+            elif self.sync_id:
+                self._send_inserted_runs(set(inserted))
+
+            self.bulk_changed = False
+
+
+    def reinsert_in_bulk(self, key) -> None:
+        """Handle an existing item as if it was inserted in bulk mode.
+
+        Changing the fields of an item that was in the model before bulk
+        mode started requires sending a whole `ModelSnapshot` when it ends.
+        Instead, QML is told to delete this item now, and it will be sent
+        with its final values like the new items.
+        """
+
+        with self._write_lock:
+            item = self._data[key]
+
+            if not self.bulk or self.bulk_changed or \
+               id(item) in self._bulk_inserted:
+                return
+
+            # Items from before bulk mode are still at their QML index
+            index = self._sorted_data.index(item)
+            del self._sorted_data[index]
+            self._sorted_data.append(item)
+            self._bulk_inserted[id(item)] = item
+
+            if self.sync_id:
+                self.send(ModelItemDeleted, self.sync_id, index)
+
+
+    def _send_inserted_runs(self, inserted_ids: Set[int]) -> None:
+        """Send a `ModelItemsInserted` for each run of new items.
+
+        Runs are sent from the first to the last, so that the indexes of
+        a run's items are already correct in QML when it's inserted.
+        """
+
+        run: List[Dict[str, Any]] = []
+        start                     = 0
+
+        for index, item in enumerate(self._sorted_data):
+            if id(item) in inserted_ids:
+                if not run:
+                    start = index
+
+                run.append(item.serialized)
+
+            elif run:
+                self.send(ModelItemsInserted, self.sync_id, start, run)
+                run = []
+
+        if run:
+            self.send(ModelItemsInserted, self.sync_id, start, run)
+
+
+    def send(self, event: Type[PyOtherSideEvent], *args) -> None:
+        """Send an event to QML, or queue it if events are deferred."""
+
+        if self.deferred_events is None:
+            event(*args)
+            return
+
+        if self._deferred_overflow:
+            return  # the snapshot sent later will include this change
+
+        self.deferred_events.append((event, args))
+
+        if len(self.deferred_events) > MAX_DEFERRED_EVENTS:
+            self.deferred_events    = []
+            self._deferred_overflow = True
+
+
+    def defer_events(self) -> None:
+        """Queue this model's events until `send_deferred_events()`."""
+
+        if self.deferred_events is None:
+            self.deferred_events = []
+
+
+    def send_deferred_events(self) -> None:
+        """Send the queued events in order and stop deferring new ones."""
+
+        with self._write_lock:
+            events               = self.deferred_events or []
+            self.deferred_events = None
+
+            if not self._deferred_overflow:
+                for event, args in events:
+                    event(*args)
+                return
+
+            self._deferred_overflow = False
+
+            if self.bulk:
+                # Items aren't sorted yet, end_bulk() will send the snapshot
+                self.bulk_changed = True
+            elif self.sync_id:
+                ModelSnapshot(
+                    self.sync_id,
+                    [item.serialized for item in self._sorted_data],
+                )
+
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Return an estimation of the memory retained by this model.
+
+        The returned dict contains the size in bytes of the model's own
+        containers and items (`items`), their string fields (`strings`),
+        attached nio events (`sources`), encryption info dicts
+        (`crypt_dicts`), and the sum of all of these (`total`).
+        Objects shared between multiple items are only counted once.
+        """
+
+        seen: Set[int] = set()
+        usage          = dict.fromkeys(
+            ("items", "strings", "sources", "crypt_dicts"), 0,
+        )
+
+        with self._write_lock:
+            usage["items"] += sys.getsizeof(self._data)
+            usage["items"] += sys.getsizeof(self._sorted_data)
+
+            for item in self._sorted_data:
+                usage["items"] += deep_sizeof(item, seen, skip_attrs=(
+                    "parent_model", *item.__dataclass_fields__,  # type: ignore
+                ))
+
+                for field in item.__dataclass_fields__:  # type: ignore
+                    value = getattr(item, field)
+
+                    kind = (
+                        "sources" if field == "source" else
+                        "crypt_dicts" if field.endswith("crypt_dict") else
+                        "strings" if isinstance(value, str) else
+                        "items"
+                    )
+
+                    usage[kind] += deep_sizeof(value, seen)
+
+        usage["total"] = sum(usage.values())
+        return usage
 
 
     def copy(self, sync_id: Optional[SyncId] = None) -> "Model":
@@ -35,6 +35,15 @@ class ModelItem:
         if getattr(self, name) == value:
             return
 
+        if self.parent_model.bulk:
+            super().__setattr__(name, value)
+
+            # Items inserted in bulk mode are sent with their final values
+            if id(self) not in self.parent_model._bulk_inserted:
+                self.parent_model.bulk_changed = True
+
+            return
+
         with self.parent_model._write_lock:
             super().__setattr__(name, value)
 
@@ -43,7 +52,8 @@ class ModelItem:
             new_index = self.parent_model._sorted_data.index(self)
 
             if self.parent_model.sync_id:
-                ModelItemFieldChanged(
+                self.parent_model.send(
+                    ModelItemFieldChanged,
                     self.parent_model.sync_id,
                     old_index,
                     new_index,
@@ -2,7 +2,7 @@
 
 from collections import UserDict
 from dataclasses import dataclass, field
-from typing import Dict
+from typing import Dict, List, Set
 
 from . import SyncId
 from .model import Model
@@ -15,9 +15,16 @@ class ModelStore(UserDict):
     The dict keys must be the sync ID of `Model` values.
     If a non-existent key is accessed, a corresponding `Model` will be
     created, put into the internal `data` dict and returned.
+
+    Models belonging to an account in `bulk_users`, i.e. tuple sync IDs
+    starting with that account's user ID, are created in bulk mode.
+    Models of an account in `deferred_users` are created with their
+    events deferred, see `Model.defer_events()`.
     """
 
-    data: Dict[SyncId, Model] = field(default_factory=dict)
+    data:           Dict[SyncId, Model] = field(default_factory=dict)
+    bulk_users:     Set[str]            = field(default_factory=set)
+    deferred_users: Set[str]            = field(default_factory=set)
 
 
     def __missing__(self, key: SyncId) -> Model:
@@ -25,9 +32,65 @@ class ModelStore(UserDict):
 
         model          = Model(sync_id=key)
         self.data[key] = model
+
+        if isinstance(key, tuple) and key[0] in self.bulk_users:
+            model.start_bulk()
+
+        if isinstance(key, tuple) and key[0] in self.deferred_users:
+            model.defer_events()
+
         return model
 
 
+    def _user_models(self, user_id: str) -> List[Model]:
+        return [
+            model for sync_id, model in self.data.items()
+            if isinstance(sync_id, tuple) and sync_id[0] == user_id
+        ]
+
+
+    def start_bulk(self, user_id: str) -> None:
+        """Put an account's current and future models in bulk mode."""
+
+        if user_id in self.bulk_users:
+            return
+
+        self.bulk_users.add(user_id)
+
+        for model in self._user_models(user_id):
+            model.start_bulk()
+
+
+    def end_bulk(self, user_id: str) -> None:
+        """End bulk mode for an account's models, see `Model.end_bulk()`."""
+
+        if user_id not in self.bulk_users:
+            return
+
+        self.bulk_users.discard(user_id)
+
+        for model in self._user_models(user_id):
+            model.end_bulk()
+
+
+    def defer_events(self, user_id: str, defer: bool = True) -> None:
+        """Stop or resume sending QML an account's model changes.
+
+        When resuming, the events queued by each model are sent in order.
+        """
+
+        if defer:
+            self.deferred_users.add(user_id)
+        else:
+            self.deferred_users.discard(user_id)
+
+        for model in self._user_models(user_id):
+            if defer:
+                model.defer_events()
+            else:
+                model.send_deferred_events()
+
+
     def __str__(self) -> str:
         """Provide a nice overview of stored models when `print()` called."""
 
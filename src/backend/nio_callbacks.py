@@ -3,10 +3,14 @@
 import asyncio
 import json
 import logging as log
+import time
 from contextlib import suppress
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import TYPE_CHECKING, Optional, Tuple
+from typing import (
+    TYPE_CHECKING, Callable, DefaultDict, Dict, List, Optional, Set, Tuple,
+    Type, Union,
+)
 from urllib.parse import quote
 
 import nio
@@ -14,10 +18,22 @@ import nio
 from . import utils
 from .html_markdown import HTML_PROCESSOR
 from .models.items import TypeSpecifier
+from .pagination import TimelineGaps
 
 if TYPE_CHECKING:
     from .matrix_client import MatrixClient
 
+# {nio type: [handler methods for it, most specific first]}
+DispatchTable = Dict[Type, List[Callable]]
+
+# nio classes whose handlers each kind of callback can call
+RESPONSE_CLASSES:   Tuple[Type, ...] = (nio.Response,)
+EPHEMERAL_CLASSES:  Tuple[Type, ...] = (nio.EphemeralEvent,)
+TO_DEVICE_CLASSES:  Tuple[Type, ...] = (nio.ToDeviceEvent,)
+ROOM_EVENT_CLASSES: Tuple[Type, ...] = (
+    nio.Event, nio.InviteEvent, nio.BadEvent, nio.UnknownBadEvent,
+)
+
 
 @dataclass
 class NioCallbacks:
@@ -25,7 +41,22 @@ class NioCallbacks:
 
     For every nio `Response` and `Event` subclasses, this class can have a
     method named `on<ClassName>` (e.g. `onRoomMessageText`) that will
-    automatically be registered in nio.
+    automatically be called for objects of that class or its subclasses.
+
+    Rather than registering one nio callback per class, which nio would
+    check with `isinstance` for every event, a single dispatcher is
+    registered for each kind of callback. The handlers for an object's
+    type are found by walking its MRO once, and memoized in a table for
+    that kind of callback. Only handlers for the classes of that kind are
+    used, e.g. a to-device `UnknownBadEvent` won't be passed to the
+    `onUnknownBadEvent` handler, which expects a room and a room event.
+
+    If the `timeNioCallbacks` setting is on, the duration of every handler
+    call is recorded in the `nio_handler_seconds` metric. After each sync
+    response, the time its handling spent in each handler is reported in
+    the `sync_handler_seconds` and `sync_handlers_seconds` metrics.
+    Handlers called by other tasks meanwhile, e.g. for past events being
+    loaded, aren't counted in these.
 
     For room event content strings, the `%1` and `%2` placeholders
     refer to the event's sender and who this event targets (`state_key`) or
@@ -36,31 +67,227 @@ class NioCallbacks:
 
     client: "MatrixClient" = field()
 
+    # {classes of a callback kind: dispatch table for that kind}
+    dispatch_tables: DefaultDict[Tuple[Type, ...], DispatchTable] = field(
+        init=False, repr=False, default_factory=lambda: DefaultDict(dict),
+    )
+
+    # {handler name: seconds} for the current sync response, when timing
+    sync_handler_seconds: DefaultDict[str, float] = field(
+        init=False, repr=False, default_factory=lambda: DefaultDict(float),
+    )
+
+    # Names of all handlers that sync_handler_seconds gauges were set for
+    sync_timed_handlers: Set[str] = field(
+        init=False, repr=False, default_factory=set,
+    )
+
+    # Task running the callbacks for a sync response, if any
+    sync_response_task: Optional[asyncio.Future] = field(
+        init=False, repr=False, default=None,
+    )
+
 
     def __post_init__(self) -> None:
-        """Register our methods as callbacks."""
+        """Register our dispatchers as callbacks."""
+
+        self.client.add_response_callback(self.dispatch_response)
+        self.client.add_event_callback(self.dispatch_event, None)
+        self.client.add_ephemeral_callback(self.dispatch_ephemeral, None)
+        self.client.add_to_device_callback(self.dispatch_to_device, None)
+
+
+    def handlers(self, type_: Type, kind: Tuple[Type, ...]) -> List[Callable]:
+        """Return our `on<ClassName>` methods for a nio type and its parents.
+
+        Only the methods for subclasses of the `kind` classes are returned.
+        """
+
+        table = self.dispatch_tables[kind]
+
+        with suppress(KeyError):
+            return table[type_]
 
-        for name, class_ in utils.classes_defined_in(nio.responses).items():
-            with suppress(AttributeError):
-                method = getattr(self, f"on{name}")
-                self.client.add_response_callback(method, class_)
+        handlers = [
+            getattr(self, f"on{cls.__name__}") for cls in type_.__mro__
+            if cls.__module__.startswith("nio.") and
+            issubclass(cls, kind) and
+            hasattr(self, f"on{cls.__name__}")
+        ]
 
-        for name, class_ in utils.classes_defined_in(nio.events).items():
-            with suppress(AttributeError):
-                method = getattr(self, f"on{name}")
-                self.client.add_event_callback(method, class_)
+        table[type_] = handlers
+        return handlers
 
-        self.client.add_ephemeral_callback(
-            self.onTypingNoticeEvent, nio.events.TypingNoticeEvent,
+
+    async def _call(self, handler: Callable, *args) -> None:
+        """Call a handler, recording its duration if timing is enabled."""
+
+        if not self.client.backend.ui_settings["timeNioCallbacks"]:
+            await handler(*args)
+            return
+
+        start = time.monotonic()
+
+        try:
+            await handler(*args)
+        finally:
+            name     = handler.__name__
+            duration = time.monotonic() - start
+            task     = asyncio.current_task()
+
+            if task and task in (
+                self.client.sync_request_task, self.sync_response_task,
+            ):
+                self.sync_handler_seconds[name] += duration
+
+            self.client.backend.metrics.observe(
+                "nio_handler_seconds",
+                duration,
+                account = self.client.user_id,
+                handler = name,
+            )
+
+
+    def _report_sync_timings(self) -> None:
+        """Record the handler durations for the sync response just handled.
+
+        The gauges of handlers that weren't called for it are set to 0.
+        """
+
+        metrics = self.client.backend.metrics
+        account = self.client.user_id
+
+        self.sync_timed_handlers.update(self.sync_handler_seconds)
+
+        for name in self.sync_timed_handlers:
+            seconds = self.sync_handler_seconds.get(name, 0)
+            metrics.set(
+                "sync_handler_seconds", seconds, account=account, handler=name,
+            )
+
+        metrics.observe(
+            "sync_handlers_seconds",
+            sum(self.sync_handler_seconds.values()),
+            account = account,
         )
 
+        self.sync_handler_seconds.clear()
+
+
+    async def dispatch_response(self, resp: nio.Response) -> None:
+        is_sync = isinstance(resp, nio.SyncResponse)
+
+        if is_sync:
+            self.sync_response_task = asyncio.current_task()
+
+        try:
+            for handler in self.handlers(type(resp), RESPONSE_CLASSES):
+                await self._call(handler, resp)
+        finally:
+            if is_sync:
+                self.sync_response_task = None
+
+        timing = self.client.backend.ui_settings["timeNioCallbacks"]
+
+        if timing and is_sync:
+            self._report_sync_timings()
+
+
+    async def dispatch_event(
+        self, room: nio.MatrixRoom, ev: nio.Event,
+    ) -> None:
+        for handler in self.handlers(type(ev), ROOM_EVENT_CLASSES):
+            await self._call(handler, room, ev)
+
+
+    async def dispatch_ephemeral(
+        self, room: nio.MatrixRoom, ev: nio.EphemeralEvent,
+    ) -> None:
+        for handler in self.handlers(type(ev), EPHEMERAL_CLASSES):
+            await self._call(handler, room, ev)
+
+
+    async def dispatch_to_device(self, ev: nio.ToDeviceEvent) -> None:
+        for handler in self.handlers(type(ev), TO_DEVICE_CLASSES):
+            await self._call(handler, ev)
+
 
     # Response callbacks
 
     async def onSyncResponse(self, resp: nio.SyncResponse) -> None:
+        await self.onPartialSyncResponse(resp)
+
+        if not self.client.first_sync_done.is_set():
+            self.client.models.end_bulk(self.client.user_id)
+
+            self.client.load_rooms_task = self.client.backend.tasks.create(
+                self.client.load_rooms_without_visible_events(),
+                "load_rooms_without_visible_events",
+                self.client.user_id,
+            )
+
+            self.client.first_sync_done.set()
+            self.client.first_sync_date = datetime.now()
+
+            account = self.client.models["accounts"][self.client.user_id]
+            account.first_sync_done = True
+
+            clients = self.client.backend.clients.values()
+            freeze  = self.client.backend.ui_settings["freezeHeapAfterSync"]
+
+            if freeze and all(c.first_sync_done.is_set() for c in clients):
+                self.client.backend.gc_monitor.freeze()
+
+        await self.client.sync_cache.save()
+
+
+    async def onPartialSyncResponse(
+        self, resp: Union[nio.SyncResponse, nio.PartialSyncResponse],
+    ) -> None:
+        """Handle the rooms of a sync response or streamed sync part."""
+
+        # nio doesn't call event callbacks for state events outside of
+        # the timeline, e.g. lazy-loaded members
         for room_id, info in resp.rooms.join.items():
-            if room_id not in self.client.past_tokens:
-                self.client.past_tokens[room_id] = info.timeline.prev_batch
+            room    = self.client.all_rooms.get(room_id)
+            summary = info.summary
+
+            if not room:
+                continue
+
+            # Nameless rooms are named from the summary's heroes and counts
+            if summary and (
+                summary.heroes or
+                summary.joined_member_count is not None or
+                summary.invited_member_count is not None
+            ):
+                self.client.invalidate_room_fields(room_id, "summary")
+            elif not info.state:
+                continue
+
+            for ev in info.state:
+                self.client.invalidate_room_fields(
+                    room_id, ev.source.get("type"),
+                )
+
+                if isinstance(ev, nio.PowerLevelsEvent):
+                    self.client.mark_all_members_dirty(room)
+                elif isinstance(ev, nio.RoomMemberEvent):
+                    self.client.mark_members_dirty(room_id, ev.state_key)
+
+            await self.client.mark_room_dirty(room)
+
+        await self.client.flush_dirty_rooms()
+
+        for room_id, info in resp.rooms.join.items():
+            gaps = self.client.timeline_gaps.setdefault(
+                room_id, TimelineGaps(),
+            )
+            gaps.synced(
+                info.timeline.prev_batch,
+                self.client.sync_since,
+                info.timeline.limited,
+            )
 
         # TODO: way of knowing if a nio.MatrixRoom is left
         for room_id, info in resp.rooms.leave.items():
@@ -80,17 +307,6 @@ class NioCallbacks:
                 self.client.all_rooms[room_id], left=True,
             )
 
-        if not self.client.first_sync_done.is_set():
-            self.client.load_rooms_task = asyncio.ensure_future(
-                self.client.load_rooms_without_visible_events(),
-            )
-
-            self.client.first_sync_done.set()
-            self.client.first_sync_date = datetime.now()
-
-            account = self.client.models["accounts"][self.client.user_id]
-            account.first_sync_done = True
-
 
     # Event callbacks
 
@@ -164,6 +380,9 @@ class NioCallbacks:
 
 
     async def onRedactionEvent(self, room, ev) -> None:
+        if await self.client.member_events.redact(room, ev.redacts):
+            return
+
         model = self.client.models[self.client.user_id, room.room_id, "events"]
         event = None
 
@@ -248,6 +467,8 @@ class NioCallbacks:
 
 
     async def onPowerLevelsEvent(self, room, ev) -> None:
+        self.client.mark_all_members_dirty(room)
+
         co = "%1 changed the room's permissions"  # TODO: improve
         await self.client.register_nio_event(room, ev, content=co)
 
@@ -351,18 +572,26 @@ class NioCallbacks:
 
 
     async def onRoomMemberEvent(self, room, ev) -> None:
+        self.client.mark_members_dirty(room.room_id, ev.state_key)
+        self.client.invalidate_room_fields(room.room_id, "m.room.member")
+
         type_and_content = await self.process_room_member_event(room, ev)
 
-        if type_and_content is not None:
+        combine = self.client.backend.ui_settings["combineMemberEvents"]
+
+        if type_and_content is not None and combine:
+            await self.client.member_events.add(room, ev, *type_and_content)
+
+        elif type_and_content is not None:
             type_specifier, content = type_and_content
 
             await self.client.register_nio_event(
                 room, ev, content=content, type_specifier=type_specifier,
             )
         else:
-            # Normally, register_nio_event() will call register_nio_room().
+            # Normally, register_nio_event() will call mark_room_dirty().
             # but in this case we don't have any event we want to register.
-            await self.client.register_nio_room(room)
+            await self.client.mark_room_dirty(room)
 
 
     async def onRoomAliasEvent(self, room, ev) -> None:
@@ -417,6 +646,10 @@ class NioCallbacks:
         co = "%1 sent an undecryptable message"
         await self.client.register_nio_event(room, ev, content=co)
 
+        self.client.undecryptable[room.room_id, ev.session_id].add(
+            ev.event_id,
+        )
+
 
     async def onBadEvent(self, room, ev) -> None:
         co = f"%1 sent a malformed <b>{ev.type}</b> event"
@@ -446,7 +679,14 @@ class NioCallbacks:
 
 
     async def onInviteEvent(self, room, ev) -> None:
-        await self.client.register_nio_room(room)
+        state_key = getattr(ev, "state_key", None)
+
+        if state_key:
+            self.client.mark_members_dirty(room.room_id, state_key)
+
+        self.client.invalidate_room_fields(room.room_id, ev.source.get("type"))
+
+        await self.client.mark_room_dirty(room)
 
 
     async def onTypingNoticeEvent(self, room, ev) -> None:
@@ -455,13 +695,37 @@ class NioCallbacks:
         if not self.client.first_sync_done.is_set():
             return
 
-        await self.client.register_nio_room(room)
+        # Typing notices are ignored while the UI is inactive
+        if self.client.backend.low_power:
+            return
 
         room_id = room.room_id
+        rooms   = self.client.models[self.client.user_id, "rooms"]
 
-        room_item = self.client.models[self.client.user_id, "rooms"][room_id]
+        if room_id not in rooms:
+            await self.client.register_nio_room(room)
 
-        room_item.typing_members = sorted(
+        rooms[room_id].typing_members = sorted(
             room.user_name(user_id) for user_id in ev.users
             if user_id not in self.client.backend.clients
         )
+
+        members  = self.client.models[self.client.user_id, room_id, "members"]
+        typing   = set(ev.users)
+        previous = self.client.typing_users.get(room_id, set())
+
+        for user_id in typing ^ previous:
+            if user_id in members:
+                members[user_id].typing = user_id in typing
+
+        self.client.typing_users[room_id] = typing
+
+
+    # To-device callbacks
+
+    async def onRoomKeyEvent(self, ev) -> None:
+        # Also receives ForwardedRoomKeyEvent, which subclasses RoomKeyEvent
+        key = (ev.room_id, ev.session_id)
+
+        if key in self.client.undecryptable:
+            await self.client.retry_decrypting_events([key])
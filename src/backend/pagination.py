@@ -0,0 +1,219 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Loading of rooms' past events page by page."""
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+import nio
+
+if TYPE_CHECKING:
+    from .matrix_client import MatrixClient
+
+# Events requested for the first page of a room, to show it quickly
+FIRST_PAGE_LIMIT = 25
+
+
+@dataclass(eq=False)
+class TimelineSpan:
+    """Contiguous events of a room's timeline that we hold.
+
+    Attributes:
+        prev_token: Pagination token for the events before the oldest one
+            of this span, empty if the span starts at the room's creation.
+
+        next_token: Sync token following the newest event of this span,
+            empty if the span is the newest one.
+    """
+
+    prev_token: str = ""
+    next_token: str = ""
+
+
+@dataclass
+class TimelineGaps:
+    """Map of a room's timeline, to only request the events we don't have.
+
+    The `spans` of events we hold are ordered from newest to oldest.
+    A sync response with a limited timeline, e.g. after being offline,
+    starts a new span: the events between it and the previous span are
+    missing. When loading past events, the gap after the newest span is
+    filled first, and once the pages reach the following span, both are
+    joined, so that the next page is requested from before the events we
+    already had instead of fetching them again.
+    """
+
+    spans: List[TimelineSpan] = field(default_factory=list)
+
+
+    @property
+    def fully_loaded(self) -> bool:
+        """Whether we have every event since the room's creation."""
+
+        return len(self.spans) == 1 and not self.spans[0].prev_token
+
+
+    def synced(self, prev_batch: str, since: str, limited: bool) -> None:
+        """Record the timeline of a sync response.
+
+        `since` is the token the sync was requested from.
+        """
+
+        if self.spans and not limited:
+            return  # continues the newest span
+
+        if self.spans:
+            self.spans[0].next_token = since
+
+        self.spans.insert(0, TimelineSpan(prev_batch))
+
+
+    def next_gap(self) -> Tuple[TimelineSpan, Optional[TimelineSpan]]:
+        """Return the span to extend backwards and the one it will reach.
+
+        The second span is `None` if there are no older events we hold.
+        """
+
+        older = self.spans[1] if len(self.spans) > 1 else None
+        return (self.spans[0], older)
+
+
+    def extend(self, span: TimelineSpan, prev_token: str) -> None:
+        """Move `span`'s start back after loading a page of events.
+
+        An empty `prev_token` means the room's creation was reached.
+        """
+
+        span.prev_token = prev_token
+
+
+    def join(self, span: TimelineSpan, older: TimelineSpan) -> None:
+        """Merge `span` with the `older` span its pages reached."""
+
+        if older in self.spans:
+            span.prev_token = older.prev_token
+            self.spans.remove(older)
+
+
+    def rewind(self, token: str) -> None:
+        """Forget the events we held, start over from a sync token."""
+
+        self.spans = [TimelineSpan(token)]
+
+
+@dataclass
+class RoomPager:
+    """Fetch a room's past events, reading the next page ahead of time.
+
+    Once a page has been returned by `next_page()`, the following one
+    is requested in the background, so that it is ready when the user
+    scrolls further up the timeline.
+
+    Many events, like membership changes, can be hidden from the timeline.
+    The size of the requested pages adapts to the measured proportion of
+    shown events (`density`), to request enough events for about
+    `target_shown` of them to be shown per page.
+    """
+
+    client:  "MatrixClient" = field(repr=False)
+    room_id: str            = field()
+
+    target_shown: int   = 50
+    min_limit:    int   = 25
+    max_limit:    int   = 500
+    density:      float = 1
+
+    pages: int = field(init=False, default=0)
+
+    _read_ahead: Optional[asyncio.Future] = field(
+        init=False, repr=False, default=None,
+    )
+    _read_ahead_range: Tuple[str, Optional[str]] = field(
+        init=False, repr=False, default=("", None),
+    )
+
+
+    @property
+    def limit(self) -> int:
+        """Number of events to request for the next page."""
+
+        if not self.pages:
+            return FIRST_PAGE_LIMIT
+
+        wanted = round(self.target_shown / max(self.density, 0.01))
+        return max(self.min_limit, min(self.max_limit, wanted))
+
+
+    def _request(self, token: str, end: Optional[str]) -> asyncio.Future:
+        return self.client.backend.tasks.create(
+            self.client.room_messages(
+                room_id = self.room_id,
+                start   = token,
+                end     = end,
+                limit   = self.limit,
+            ),
+            "room_messages",
+            self.client.user_id,
+            self.room_id,
+        )
+
+
+    async def next_page(
+        self, token: str, end: Optional[str] = None, read_ahead: bool = True,
+    ) -> nio.RoomMessagesResponse:
+        """Return the page of events before `token`, stopping at `end`.
+
+        If `read_ahead` is `True`, start fetching the following page.
+        """
+
+        pending  = self._read_ahead
+        response = None
+
+        if pending and self._read_ahead_range == (token, end):
+            self._read_ahead = None
+
+            # If reading ahead failed or was cancelled by close_room(),
+            # the request is simply made again
+            try:
+                response = await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():  # we were cancelled ourselves
+                    pending.cancel()
+                    raise
+            except Exception:
+                pass
+
+        if response is None:
+            self.cancel()
+            response = await self._request(token, end)
+
+        self.pages += 1
+
+        more = response.chunk and response.end not in (token, end)
+
+        if read_ahead and response.end and more:
+            self._read_ahead       = self._request(response.end, end)
+            self._read_ahead_range = (response.end, end)
+
+            # Avoid "exception never retrieved" warnings if never awaited
+            self._read_ahead.add_done_callback(
+                lambda fut: fut.cancelled() or fut.exception(),
+            )
+
+        return response
+
+
+    def observe_density(self, events: int, shown: int) -> None:
+        """Update `density` after `shown` of a page's `events` were shown."""
+
+        if events:
+            self.density = (self.density + shown / events) / 2
+
+
+    def cancel(self) -> None:
+        """Cancel the request for the next page if it is running."""
+
+        if self._read_ahead:
+            self._read_ahead.cancel()
+            self._read_ahead = None
@@ -1,7 +1,7 @@
 # SPDX-License-Identifier: LGPL-3.0-or-later
 
 from dataclasses import dataclass, field
-from typing import TYPE_CHECKING, Any, Optional
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
 
 import pyotherside
 
@@ -70,6 +70,15 @@ class ModelItemInserted(PyOtherSideEvent):
     item:    "ModelItem" = field()
 
 
+@dataclass
+class ModelItemsInserted(PyOtherSideEvent):
+    """Indicate the insertion of consecutive `ModelItem` into a `Model`."""
+
+    sync_id: "SyncId"             = field()
+    index:   int                  = field()
+    items:   List[Dict[str, Any]] = field()
+
+
 @dataclass
 class ModelItemFieldChanged(PyOtherSideEvent):
     """Indicate a `ModelItem`'s field value change in a `Backend` `Model`."""
@@ -94,3 +103,14 @@ class ModelCleared(PyOtherSideEvent):
     """Indicate that a `Backend` `Model` was cleared."""
 
     sync_id: "SyncId" = field()
+
+
+@dataclass
+class ModelSnapshot(PyOtherSideEvent):
+    """Indicate that a `Backend` `Model`'s content must be entirely replaced.
+
+    Sent instead of individual item events when a model leaves bulk mode.
+    """
+
+    sync_id: "SyncId"             = field()
+    items:   List[Dict[str, Any]] = field()
@@ -72,6 +72,7 @@ class QMLBridge:
 
         def on_done(future: Future) -> None:
             """Send a PyOtherSide event with the coro's result/exception."""
+            self.backend.metrics.add("pending_bridge_calls", -1)
             result = exception = trace = None
 
             try:
@@ -82,6 +83,10 @@ class QMLBridge:
 
             CoroutineDone(uuid, result, exception, trace)
 
+        self._loop.call_soon_threadsafe(
+            self.backend.metrics.add, "pending_bridge_calls", 1,
+        )
+
         future = asyncio.run_coroutine_threadsafe(coro, self._loop)
         future.add_done_callback(on_done)
         return future
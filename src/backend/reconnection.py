@@ -0,0 +1,114 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Backoff and connectivity probing for reconnecting to homeservers."""
+
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+from aiohttp import ClientError
+
+if TYPE_CHECKING:
+    from .matrix_client import MatrixClient
+
+# Successful probes are trusted by other accounts for this many seconds
+PROBE_VALIDITY = 5
+
+PROBE_TIMEOUT = 10
+
+
+@dataclass
+class HomeserverBackoff:
+    """Reconnection state shared by the accounts of one homeserver.
+
+    After a failure, clients wait for a random delay between zero and an
+    exponentially growing cap ("full jitter"), then check that the server
+    answers the cheap `/versions` API before resuming their long-polling
+    syncs. Since the state is shared, many accounts on a server that just
+    came back won't all hit it at the same time, and only one of them
+    needs to probe it.
+
+    Failed syncs count towards the backoff too, so that a server which
+    answers probes but keeps failing or timing out syncs doesn't get
+    retried every second. At most one failure is counted between two
+    probe requests, no matter how many accounts are waiting for the server.
+
+    Attributes:
+        failures: Failures since the last successful sync.
+    """
+
+    base_delay: float = 1
+    max_delay:  float = 300
+
+    failures: int = field(init=False, default=0)
+
+    _failure_counted:    bool  = field(init=False, default=False)
+    _last_probe_success: float = field(init=False, default=0)
+    _last_probe_failure: float = field(init=False, default=0)
+    _probe_lock: asyncio.Lock = field(
+        init=False, repr=False, default_factory=asyncio.Lock,
+    )
+
+
+    def next_delay(self) -> float:
+        """Return how long to wait before retrying after a failure."""
+
+        exponent = min(self.failures, 32)  # avoid float overflows
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** exponent),
+        )
+
+
+    def failed(self) -> None:
+        """Count a failed sync or probe, once per probe request."""
+
+        if not self._failure_counted:
+            self.failures         += 1
+            self._failure_counted  = True
+
+
+    def succeeded(self) -> None:
+        """Reset the backoff after a successful sync."""
+
+        self.failures         = 0
+        self._failure_counted = False
+
+
+    async def probe(self, client: "MatrixClient") -> bool:
+        """Return whether the homeserver answers a `/versions` request.
+
+        If another account checked in the last `PROBE_VALIDITY` seconds,
+        no request is made and its result is returned.
+        A successful probe doesn't reset the backoff, only a successful
+        sync does.
+        """
+
+        async with self._probe_lock:
+            now = time.monotonic()
+
+            if now - self._last_probe_success < PROBE_VALIDITY:
+                return True
+
+            if now - self._last_probe_failure < PROBE_VALIDITY:
+                return False
+
+            self._failure_counted = False
+
+            try:
+                response = await client.send(
+                    "GET", "/_matrix/client/versions", timeout=PROBE_TIMEOUT,
+                )
+                response.release()
+                ok = response.status == 200
+            except (ClientError, asyncio.TimeoutError):
+                ok = False
+
+            if ok:
+                self._last_probe_success = time.monotonic()
+            else:
+                self._last_probe_failure = time.monotonic()
+                self.failed()
+
+            return ok
@@ -0,0 +1,256 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Persisted sync state allowing clients to start with an incremental sync."""
+
+import asyncio
+import logging as log
+import pickle
+import time
+from copy import copy
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+import nio
+
+from .html_markdown import HTML_PROCESSOR as HTML
+from .models.items import Member, Room
+from .pagination import TimelineGaps
+from .utils import atomic_write
+
+if TYPE_CHECKING:
+    from .matrix_client import MatrixClient
+
+# Increase when the saved data's structure changes to ignore old caches
+CACHE_VERSION = 2
+
+# Number of nio rooms pickled between each time other tasks are let to run
+ROOMS_PER_STEP = 20
+
+
+@dataclass
+class SyncCache:
+    """Save and restore a client's sync token, nio rooms and room models.
+
+    A full initial sync of an account with hundreds of rooms can take minutes.
+    Instead, the last `next_batch` token is saved along with the nio
+    `MatrixRoom` objects it corresponds to and our `Room` and `Member` model
+    items, so that the next start can restore them and only ask the server
+    for what changed since.
+
+    Events aren't saved. After a warm start, the `TimelineGaps` map of
+    every restored room starts from the saved sync token, from which
+    their past events will be loaded.
+
+    If the server refuses the saved token, `discard()` resets the client's
+    state for a full initial sync.
+
+    Attributes:
+        save_interval: Minimum number of seconds between saves after
+            the first sync response.
+
+        resumed_token: The `next_batch` token restored by `load()`,
+            empty if the client did a cold start.
+    """
+
+    client: "MatrixClient" = field(repr=False)
+
+    save_interval: float = 300
+    resumed_token: str   = ""
+
+    _last_save: Optional[float] = field(init=False, default=None)
+
+
+    @property
+    def path(self) -> Path:
+        """Path of the cache file for this client's account and device."""
+
+        cache_dir = Path(self.client.backend.appdirs.user_cache_dir)
+        name      = f"{self.client.user_id}.{self.client.device_id}.pickle"
+        return cache_dir / "sync" / name
+
+
+    @staticmethod
+    def _item_fields(item: Any) -> Dict[str, Any]:
+        return {f.name: copy(getattr(item, f.name)) for f in fields(item)}
+
+
+    def _snapshot(self) -> Dict[str, Any]:
+        """Return a copy of the state to save made of plain data.
+
+        The nio rooms are left to `_pickle_rooms()`, which must be awaited
+        right after, before the state changes.
+        """
+
+        client  = self.client
+        user_id = client.user_id
+        members = {}
+
+        for room_id in client.all_rooms:
+            model            = client.models[user_id, room_id, "members"]
+            members[room_id] = [self._item_fields(m) for m in model.values()]
+
+        return {
+            "version":    CACHE_VERSION,
+            "next_batch": client.next_batch,
+            "room_items": [
+                self._item_fields(r)
+                for r in client.models[user_id, "rooms"].values()
+            ],
+            "member_items": members,
+        }
+
+
+    async def _pickle_rooms(
+        self, rooms: Dict[str, nio.MatrixRoom],
+    ) -> Dict[str, bytes]:
+        """Pickle nio rooms one by one, letting other tasks run regularly.
+
+        nio rooms can't be pickled in another thread while syncs update
+        them, but pickling a few at a time keeps the loop responsive.
+        """
+
+        pickled = {}
+
+        for i, (room_id, room) in enumerate(list(rooms.items()), 1):
+            pickled[room_id] = pickle.dumps(
+                room, protocol=pickle.HIGHEST_PROTOCOL,
+            )
+
+            if i % ROOMS_PER_STEP == 0:
+                await asyncio.sleep(0)
+
+        return pickled
+
+
+    async def save(self, force: bool = False) -> None:
+        """Save the client's current sync state on disk.
+
+        Unless `force` is `True`, nothing is done if the previous save
+        happened less than `save_interval` seconds ago.
+        """
+
+        now = time.monotonic()
+
+        if not force and self._last_save is not None and \
+           now - self._last_save < self.save_interval:
+            return
+
+        self._last_save = now
+
+        if not self.client.next_batch:
+            return
+
+        # Copy the state now, while it matches our next_batch token. The
+        # next sync only starts after this response callback returns.
+        state                  = self._snapshot()
+        state["rooms"]         = await self._pickle_rooms(self.client.rooms)
+        state["invited_rooms"] = \
+            await self._pickle_rooms(self.client.invited_rooms)
+
+        data = await asyncio.get_event_loop().run_in_executor(
+            None, pickle.dumps, state, pickle.HIGHEST_PROTOCOL,
+        )
+
+        path = self.path
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        async with atomic_write(path, binary=True) as (out, done):
+            await out.write(data)
+            done()
+
+
+    async def load(self) -> bool:
+        """Restore the saved sync state into the client and its models.
+
+        Return whether a saved state was found and restored.
+        Must be called before the client starts syncing.
+        """
+
+        client = self.client
+
+        def read() -> Dict[str, Any]:
+            data = pickle.loads(self.path.read_bytes())
+
+            if data["version"] != CACHE_VERSION:
+                raise ValueError(f"Unsupported version {data['version']}")
+
+            for key in ("rooms", "invited_rooms"):
+                data[key] = {
+                    room_id: pickle.loads(room)
+                    for room_id, room in data[key].items()
+                }
+
+            return data
+
+        try:
+            data = await asyncio.get_event_loop().run_in_executor(None, read)
+
+        except FileNotFoundError:
+            return False
+
+        except Exception as err:  # corrupted file, nio update, etc.
+            log.warning("Ignoring sync cache for %s: %r", client.user_id, err)
+            self.invalidate()
+            return False
+
+        client.rooms.update(data["rooms"])
+        client.invited_rooms.update(data["invited_rooms"])
+
+        for room_fields in data["room_items"]:
+            room = Room(**room_fields)
+            room.typing_members = []
+            client.models[client.user_id, "rooms"][room.id] = room
+
+        for room_id, member_fields in data["member_items"].items():
+            members = client.models[client.user_id, room_id, "members"]
+
+            for member in (Member(**f) for f in member_fields):
+                member.typing      = False
+                members[member.id] = member
+
+            for user_id, user in client.all_rooms[room_id].users.items():
+                if user.display_name:
+                    HTML.rooms_user_id_names[room_id][user_id] = \
+                        user.display_name
+
+        for room_id in client.rooms:
+            gaps = client.timeline_gaps.setdefault(room_id, TimelineGaps())
+            gaps.rewind(data["next_batch"])
+
+        client.next_batch  = data["next_batch"]
+        self.resumed_token = data["next_batch"]
+        return True
+
+
+    def invalidate(self) -> None:
+        """Delete the saved sync state from disk."""
+
+        self.resumed_token = ""
+
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+    async def discard(self) -> None:
+        """Forget the restored sync state to do a full initial sync again."""
+
+        client = self.client
+        self.invalidate()
+
+        client.next_batch = ""
+        client.timeline_gaps.clear()
+
+        for room_id in {*client.rooms, *client.invited_rooms}:
+            client.models.pop((client.user_id, room_id, "members"), None)
+            HTML.rooms_user_id_names.pop(room_id, None)
+
+        client.derived_room_fields.clear()
+        client.rooms.clear()
+        client.invited_rooms.clear()
+        client.models[client.user_id, "rooms"].clear()
+
+        # Like for a cold start, until the first sync is done
+        client.models.start_bulk(client.user_id)
@@ -0,0 +1,210 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Background task tracking, cancellation and leak detection."""
+
+import asyncio
+import logging as log
+import time
+from contextlib import suppress
+from dataclasses import dataclass, field
+from typing import (
+    Awaitable, Collection, DefaultDict, Dict, List, Set, Tuple,
+)
+
+Owner = Tuple[str, ...]
+
+
+@dataclass
+class TaskInfo:
+    """Details about a task registered in a `TaskRegistry`.
+
+    The `owner` is a tuple going from the most general to the most specific
+    owner, e.g. `(user_id,)` for an account's task or `(user_id, room_id)`
+    for a task concerning a room of that account.
+    Tasks which are expected to run as long as their owner exists,
+    like sync or file writing loops, are marked as `daemon`.
+    """
+
+    name:    str   = field()
+    owner:   Owner = field()
+    daemon:  bool  = False
+    created: float = field(default_factory=time.monotonic)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.created
+
+
+@dataclass
+class TaskRegistry:
+    """Name, group and keep track of the backend's background tasks.
+
+    Tasks are unregistered automatically when they finish.
+    Lock tables, `{key: asyncio.Lock}` dicts that would otherwise only grow,
+    can be registered to be pruned of their unused locks by `watch()`.
+
+    Attributes:
+        tasks: The `{task: info}` dict for currently running tasks.
+
+        lock_tables: `{name: table}` lock dicts to monitor and prune.
+
+        long_lived_after: Seconds after which a non-daemon task
+            is considered to be possibly leaked.
+    """
+
+    tasks: Dict[asyncio.Future, TaskInfo] = field(default_factory=dict)
+
+    lock_tables: Dict[str, DefaultDict[str, asyncio.Lock]] = field(
+        default_factory=dict,
+    )
+
+    long_lived_after: float = 600
+
+    _warned: Set[asyncio.Future] = field(init=False, default_factory=set)
+
+
+    def create(
+        self, coro: Awaitable, name: str, *owner: str, daemon: bool = False,
+    ) -> asyncio.Future:
+        """Schedule a coroutine to run as a task, register and return it."""
+
+        task = asyncio.ensure_future(coro)
+        return self.register(task, name, *owner, daemon=daemon)
+
+
+    def register(
+        self,
+        task:   asyncio.Future,
+        name:   str,
+        *owner: str,
+        daemon: bool = False,
+    ) -> asyncio.Future:
+        """Register an existing task, e.g. the one returned by `current_task`.
+        """
+
+        self.tasks[task] = TaskInfo(name, owner, daemon)
+
+        def unregister(task: asyncio.Future) -> None:
+            self.tasks.pop(task, None)
+            self._warned.discard(task)
+
+        task.add_done_callback(unregister)
+        return task
+
+
+    def owned_by(self, *owner: str) -> List[asyncio.Future]:
+        """Return tasks belonging to `owner` or one of its sub-owners.
+
+        For example, `owned_by(user_id)` will return both the tasks owned by
+        `(user_id,)` and `(user_id, room_id)`.
+        """
+
+        return [
+            task for task, info in self.tasks.items()
+            if info.owner[:len(owner)] == owner
+        ]
+
+
+    async def cancel(self, *owner: str) -> int:
+        """Cancel and wait for the tasks returned by `owned_by(*owner)`.
+
+        The task calling this method is never cancelled.
+        Return the number of cancelled tasks.
+        """
+
+        current = asyncio.current_task()
+        tasks   = [t for t in self.owned_by(*owner) if t is not current]
+
+        for task in tasks:
+            task.cancel()
+
+        for task in tasks:
+            with suppress(asyncio.CancelledError, Exception):
+                await task
+
+        return len(tasks)
+
+
+    def prune_locks(self) -> Dict[str, int]:
+        """Remove unused locks from the lock tables.
+
+        A lock is unused if it isn't held and no task is waiting for it,
+        which makes it identical to the new lock a `DefaultDict` would create.
+        Return a `{table_name: removed_count}` dict.
+        """
+
+        removed: Dict[str, int] = {}
+
+        for name, table in self.lock_tables.items():
+            unused = [
+                key for key, lock in table.items()
+                if not lock.locked() and not getattr(lock, "_waiters", None)
+            ]
+
+            for key in unused:
+                del table[key]
+
+            removed[name] = len(unused)
+
+        return removed
+
+
+    def long_lived(self) -> List[Tuple[asyncio.Future, TaskInfo]]:
+        """Return non-daemon tasks older than `long_lived_after` seconds."""
+
+        return [
+            (task, info) for task, info in self.tasks.items()
+            if not info.daemon and info.age > self.long_lived_after
+        ]
+
+
+    async def watch(self, interval: float = 300) -> None:
+        """Periodically prune lock tables and warn about long-lived tasks."""
+
+        while True:
+            await asyncio.sleep(interval)
+
+            self.prune_locks()
+
+            for task, info in self.long_lived():
+                if task not in self._warned:
+                    self._warned.add(task)
+                    log.warning(
+                        "Task %r owned by %r running since %ds, leaked?",
+                        info.name, info.owner, info.age,
+                    )
+
+
+    def report(self, orphan_owners: Collection[str] = ()) -> str:
+        """Return a human-readable summary of running tasks and lock tables.
+
+        Tasks whose top-level owner is part of `orphan_owners`,
+        e.g. accounts that are no longer logged in, are reported as leaked.
+        """
+
+        lines = []
+        infos = sorted(
+            self.tasks.values(), key=lambda info: (info.owner, -info.age),
+        )
+
+        for info in infos:
+            flags = (
+                "leaked" if info.owner and info.owner[0] in orphan_owners else
+                "daemon" if info.daemon else
+                "long-lived" if info.age > self.long_lived_after else
+                ""
+            )
+
+            owner = " ".join(info.owner)
+            lines.append(
+                f"{info.age:>9.1f}s  {owner}  {info.name}  {flags}".rstrip(),
+            )
+
+        lines.append(f"{len(self.tasks)} tasks")
+        lines.append("")
+
+        for name, table in self.lock_tables.items():
+            held = sum(1 for lock in table.values() if lock.locked())
+            lines.append(f"{len(table):>9}  {name} ({held} held)")
+
+        return "\n".join(lines)
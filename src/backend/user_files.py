@@ -39,7 +39,10 @@ class DataFile:
 
 
     def __post_init__(self) -> None:
-        asyncio.ensure_future(self._write_loop())
+        self.backend.tasks.create(
+            self._write_loop(), "_write_loop", "data_files", self.filename,
+            daemon=True,
+        )
 
 
     @property
@@ -159,6 +162,7 @@ class JSONDataFile(DataFile):
     async def write(self, data: JsonData) -> None:
         js = json.dumps(data, indent=4, ensure_ascii=False, sort_keys=True)
         await super().write(js)
+        self._data = data
 
 
 @dataclass
@@ -224,9 +228,15 @@ class UISettings(JSONDataFile):
             "clearRoomFilterOnEnter": True,
             "clearRoomFilterOnEscape": True,
             "collapseSidePanesUnderWindowWidth": 400,
-            "hideProfileChangeEvents": True,
+            "hideProfileChangeEvents": False,
             "hideMembershipEvents": False,
+            "combineMemberEvents": True,
             "hideUnknownEvents": False,
+            "syncTimelineLimit": 10,
+            "metricsExporterAddress": "",
+            "freezeHeapAfterSync": False,
+            "streamSyncResponses": False,
+            "timeNioCallbacks": False,
             "theme": "Midnight.qpl",
             "writeAliases": {},
             "media": {
@@ -240,6 +250,7 @@ class UISettings(JSONDataFile):
             "keys": {
                 "startPythonDebugger": ["Alt+Shift+D"],
                 "toggleDebugConsole":  ["Alt+Shift+C", "F1"],
+                "diffHeapSnapshots":   ["Alt+Shift+M"],
                 "reloadConfig":        ["Alt+Shift+R"],
 
                 "zoomIn":            ["Ctrl++"],
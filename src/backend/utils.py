@@ -14,9 +14,10 @@ from enum import Enum
 from enum import auto as autostr
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from types import ModuleType
+from types import BuiltinFunctionType, FunctionType, MethodType, ModuleType
 from typing import (
-    Any, AsyncIterator, Callable, Dict, Mapping, Sequence, Tuple, Type, Union,
+    Any, AsyncIterator, Callable, Collection, Dict, Mapping, Optional,
+    Sequence, Set, Tuple, Type, Union,
 )
 from uuid import UUID
 
@@ -51,6 +52,68 @@ class AutoStrEnum(Enum):
         return name
 
 
+class ObservedDict(dict):
+    """A dict calling `on_change(key)` after any key is set or removed.
+
+    Pickling or copying an `ObservedDict` results in a normal dict,
+    without the callback.
+    """
+
+    def __init__(self, on_change: Callable[[Any], None]) -> None:
+        super().__init__()
+        self.on_change = on_change
+
+
+    def __reduce__(self) -> Tuple[Type[dict], Tuple[dict]]:
+        return (dict, (dict(self),))
+
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        self.on_change(key)
+
+
+    def __delitem__(self, key) -> None:
+        super().__delitem__(key)
+        self.on_change(key)
+
+
+    def pop(self, key, *default):
+        had_key = key in self
+        value   = super().pop(key, *default)
+
+        if had_key:
+            self.on_change(key)
+
+        return value
+
+
+    def popitem(self) -> Tuple[Any, Any]:
+        key, value = super().popitem()
+        self.on_change(key)
+        return (key, value)
+
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+
+        return self[key]
+
+
+    def update(self, *args, **kwargs) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+    def clear(self) -> None:
+        keys = list(self)
+        super().clear()
+
+        for key in keys:
+            self.on_change(key)
+
+
 def dict_update_recursive(dict1: dict, dict2: dict) -> None:
     """Deep-merge `dict1` and `dict2`, recursive version of `dict.update()`."""
     # https://gist.github.com/angstwad/bf22d1822c38a92ec0a9
@@ -199,6 +262,65 @@ def classes_defined_in(module: ModuleType) -> Dict[str, Type]:
     }
 
 
+def deep_sizeof(
+    obj:        Any,
+    seen:       Optional[Set[int]] = None,
+    skip_attrs: Collection[str]    = ("parent_model", "transport_response"),
+) -> int:
+    """Return an estimation of the memory size of an object in bytes.
+
+    Unlike `sys.getsizeof()`, the size of contained objects, e.g. the keys
+    and values of a dict or the attributes of an instance, is also counted.
+
+    Objects whose `id()` is in `seen` are not counted.
+    Every object that gets counted is added to `seen`, pass the same set
+    to multiple calls to avoid counting shared objects more than once.
+
+    Classes, modules and functions are ignored, as well as
+    instance attributes named in `skip_attrs`. By default, these are
+    `ModelItem.parent_model` and the `transport_response` of nio responses,
+    which would make us count an entire `Model` or aiohttp session.
+    """
+
+    seen    = set() if seen is None else seen
+    ignored = (type, ModuleType, FunctionType, BuiltinFunctionType, MethodType)
+    stack   = [obj]
+    size    = 0
+
+    while stack:
+        obj = stack.pop()
+
+        if id(obj) in seen or isinstance(obj, ignored):
+            continue
+
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, (str, bytes, bytearray, int, float, bool)):
+            continue
+
+        if isinstance(obj, Mapping):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, Collection):
+            stack.extend(obj)
+
+        attrs = getattr(obj, "__dict__", None)
+
+        if isinstance(attrs, dict) and id(attrs) not in seen:
+            seen.add(id(attrs))
+            size += sys.getsizeof(attrs)
+            stack.extend(v for k, v in attrs.items() if k not in skip_attrs)
+
+        slots = getattr(type(obj), "__slots__", ())
+
+        for slot in (slots,) if isinstance(slots, str) else slots:
+            if slot not in skip_attrs and hasattr(obj, slot):
+                stack.append(getattr(obj, slot))
+
+    return size
+
+
 @asynccontextmanager
 async def atomic_write(
     path: Union[Path, str], binary: bool = False, **kwargs,
@@ -63,6 +63,13 @@ HDrawer {
         Special commands:
             .j OBJECT, .json OBJECT  Print OBJECT as human-readable JSON
 
+            .m, .memory        Print backend memory usage, sorted by size
+            .m n, .memory n    Print backend memory usage, sorted by name
+            .s, .stats         Print backend metrics in OpenMetrics format
+            .ta, .tasks        Print backend tasks and lock tables
+            .hd, .heapdiff     Take a heap snapshot and print changes since
+                               the previous one, first use starts tracing
+
             .t, .top     Attach the console to the parent window's top
             .b, .bottom  Attach the console to the parent window's bottom
             .l, .left    Attach the console to the parent window's left
@@ -91,6 +98,15 @@ HDrawer {
     }
 
 
+    function printBackendResult(name, args=[]) {
+        py.callCoro(name, args, result => {
+            commandsView.model.insert(0, {
+                input: "", output: String(result), error: false,
+            })
+        })
+    }
+
+
     function runJS(input, addToHistory=true) {
         if (addToHistory && history.slice(-1)[0] !== input) {
             history.push(input)
@@ -117,6 +133,21 @@ HDrawer {
             } else if ([".r", ".right"].includes(input)) {
                 debugConsole.edge = Qt.RightEdge
 
+            } else if ([".m", ".memory"].includes(input)) {
+                printBackendResult("memory_report", [true])
+
+            } else if ([".m n", ".memory n"].includes(input)) {
+                printBackendResult("memory_report", [false])
+
+            } else if ([".s", ".stats"].includes(input)) {
+                printBackendResult("get_metrics")
+
+            } else if ([".ta", ".tasks"].includes(input)) {
+                printBackendResult("tasks_report")
+
+            } else if ([".hd", ".heapdiff"].includes(input)) {
+                printBackendResult("heap_snapshot_diff")
+
             } else if (input.startsWith(".j ") || input.startsWith(".json ")) {
                 output = JSON.stringify(eval(input.substring(2)), null, 4)
 
@@ -140,6 +171,14 @@ HDrawer {
         onActivated: debugConsole.toggle()
     }
 
+    HShortcut {
+        sequences: settings.keys.diffHeapSnapshots
+        onActivated: {
+            debugConsole.visible = true
+            debugConsole.printBackendResult("heap_snapshot_diff")
+        }
+    }
+
     HColumnLayout {
         anchors.fill: parent
 
@@ -2,6 +2,7 @@
 
 import QtQuick 2.12
 import Qt.labs.platform 1.1
+import ".."
 import "../Popups"
 import "../PythonBridge"
 
@@ -18,12 +19,19 @@ HFileDialogOpener {
     property bool importing: false
     property Future importFuture: null
 
+    readonly property QtObject account: ModelStore.get("accounts").find(userId)
+
 
     PasswordPopup {
         id: importPasswordPopup
         details.text:
+            importing && account && account.keys_total ?
+            qsTr("Importing keys (%1/%2)...")
+            .arg(account.keys_processed).arg(account.keys_total) :
+
             importing ?
             qsTr("This might take a while...") :
+
             qsTr("Passphrase used to protect this file:")
         okText: qsTr("Import")
 
@@ -47,4 +47,18 @@ HBox {
 
         Layout.fillWidth: true
     }
+
+    HLabel {
+        readonly property QtObject info: accountSettings.accountInfo
+
+        wrapMode: Text.Wrap
+        text:
+            info && info.keys_total ?
+            qsTr("Processed %1 of %2 keys...")
+            .arg(info.keys_processed).arg(info.keys_total) :
+            ""
+
+        Layout.maximumHeight: text ? implicitHeight : 0
+        Layout.fillWidth: true
+    }
 }
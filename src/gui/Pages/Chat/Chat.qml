@@ -11,6 +11,7 @@ Item {
 
     onFocusChanged: if (focus && loader.item) loader.item.composer.takeFocus()
     onReadyChanged: longLoading = false
+    Component.onDestruction: py.callClientCoro(userId, "close_room", [roomId])
 
 
     property string userId
@@ -10,6 +10,10 @@ HColumnLayout {
     readonly property alias keybindFocusItem: filterField
 
 
+    Component.onCompleted: py.callClientCoro(
+        chat.userId, "load_all_room_members", [chat.roomId],
+    )
+
     HListView {
         id: memberList
         clip: true
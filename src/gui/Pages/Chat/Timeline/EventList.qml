@@ -168,7 +168,8 @@ Rectangle {
         }
 
         onYPosChanged:
-            if (canLoad && yPos < 0.1) Qt.callLater(loadPastEvents)
+            if (canLoad && (yPos < 0.1 || eventsAbove() < loadAheadEvents))
+                Qt.callLater(loadPastEvents)
 
         // When an invited room becomes joined, we should now be able to
         // fetch past events.
@@ -180,6 +181,9 @@ Rectangle {
         property bool canLoad: true
         property bool loading: false
 
+        // Load more events when there are less than this above the view
+        property int loadAheadEvents: 30
+
         property bool ownEventsOnRight:
             width < theme.chat.eventList.ownEventsOnRightUnderWidth
 
@@ -223,6 +227,12 @@ Rectangle {
             Clipboard.text = contents.join("\n\n")
         }
 
+        function eventsAbove() {
+            // Newest events are at the bottom and have the lowest indexes
+            const topIndex = indexAt(contentX, contentY)
+            return topIndex === -1 ? Infinity : count - 1 - topIndex
+        }
+
         function canRedact(eventModel) {
             return eventModel.event_type !== "RedactedEvent" &&
                    (chat.roomInfo.can_redact_all ||
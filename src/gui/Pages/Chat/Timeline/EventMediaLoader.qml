@@ -99,7 +99,8 @@ HLoader {
         const args = [
             loader.mediaUrl,
             loader.title,
-            JSON.parse(loader.singleMediaInfo.media_crypt_dict)
+            JSON.parse(loader.singleMediaInfo.media_crypt_dict),
+            false,  // requested by the user, don't wait for low-power mode
         ]
 
         py.callCoro("media_cache.get_media", args, path => {
@@ -55,6 +55,20 @@ QtObject {
     }
 
 
+    function onModelItemsInserted(syncId, index, items) {
+        // print("insert many", syncId, index, items.length)
+        const model = ModelStore.get(syncId)
+
+        if (index === model.count) {
+            model.append(items)
+            return
+        }
+
+        for (let i = 0; i < items.length; i++)
+            model.insert(index + i, items[i])
+    }
+
+
     function onModelItemFieldChanged(syncId, oldIndex, newIndex, field, value){
         // print("change", syncId, oldIndex, newIndex, field, value)
         const model = ModelStore.get(syncId)
@@ -74,4 +88,12 @@ QtObject {
         // print("clear", syncId)
         ModelStore.get(syncId).clear()
     }
+
+
+    function onModelSnapshot(syncId, items) {
+        // print("snapshot", syncId, items.length)
+        const model = ModelStore.get(syncId)
+        model.clear()
+        model.append(items)
+    }
 }
@@ -26,6 +26,8 @@ ApplicationWindow {
             window.visibility === window.Minimized ||
             window.visibility === window.Hidden
 
+    onHiddenChanged: py.callCoro("set_low_power", [hidden])
+
     // NOTE: For JS object variables, the corresponding method to notify
     // key/value changes must be called manually, e.g. settingsChanged().
     property var mainPaneModelSource: []